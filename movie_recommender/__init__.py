@@ -29,7 +29,47 @@ RECOMMENDATIONS_CACHE_TIME = int(os.environ["RECOMMENDATIONS_CACHE_TIME"])
 assert "BACKGROUND_PORT" in os.environ, "BACKGROUND_PORT must be set in .env"
 BACKGROUND_PORT = int(os.environ["BACKGROUND_PORT"])
 
+# optional, how many background jobs run at once and how many may wait before
+# save_ratings turns new ones away
+BACKGROUND_WORKERS = int(os.environ.get("BACKGROUND_WORKERS", 4))
+BACKGROUND_QUEUE_SIZE = int(os.environ.get("BACKGROUND_QUEUE_SIZE", 256))
+
+# optional, bulk jobs like backfills wait in their own lane behind the ones of
+# save_ratings, at most BULK_MAX_RUNNING of them run at once and one goes
+# first once the lane has not started a job for BULK_MAX_WAIT seconds
+BULK_QUEUE_SIZE = int(os.environ.get("BULK_QUEUE_SIZE", 100_000))
+BULK_MAX_RUNNING = int(
+    os.environ.get("BULK_MAX_RUNNING", max(1, BACKGROUND_WORKERS // 2))
+)
+BULK_MAX_WAIT = float(os.environ.get("BULK_MAX_WAIT", 30))
+
+# optional, how the queue runs a job: http to the background api, uds to the
+# background api listening on BACKGROUND_SOCKET or process for a local pool
+BACKGROUND_EXECUTOR = os.environ.get("BACKGROUND_EXECUTOR", "http")
+assert BACKGROUND_EXECUTOR in (
+    "http",
+    "uds",
+    "process",
+), "BACKGROUND_EXECUTOR must be http, uds or process"
+BACKGROUND_SOCKET = os.environ.get(
+    "BACKGROUND_SOCKET", str(REPO_PATH / "instance" / "background.sock")
+)
+
+# optional, job processes the background api forks after loading the models,
+# 0 runs the jobs in threads of the api process itself
+BACKGROUND_PROCESSES = int(os.environ.get("BACKGROUND_PROCESSES", 0))
+
+# optional, a sqlite file for the job status so every web worker sees it, kept
+# in memory when unset. Records expire JOB_STATUS_TTL seconds after an update
+JOB_STATUS_DB = os.environ.get("JOB_STATUS_DB")
+JOB_STATUS_TTL = float(os.environ.get("JOB_STATUS_TTL", 3600))
+
 
 MIN_RATING_LEN = 5
 MIN_SCORE = 0.2
 MAX_RECOMENDATIOSN = 20
+# the jobs keep this many times MAX_RECOMENDATIOSN, room for the genre filter
+RECOMMENDATION_HEADROOM = 10
+
+# precomputed indexes and models that are rebuilt with the flask cli
+INDEX_PATH = REPO_PATH / "instance" / "indexes"
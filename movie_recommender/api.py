@@ -7,8 +7,10 @@ from movie_recommender import (
     RECOMMENDATIONS_CACHE_TIME,
     RECOMMENDATIONS_CACHED_N_USERS,
     BACKGROUND_PORT,
+    BACKGROUND_EXECUTOR,
+    BACKGROUND_SOCKET,
 )
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, Response
 from flask_user import login_required
 from flask_login import current_user
 from collections import namedtuple
@@ -17,6 +19,7 @@ from movie_recommender.querying.sql_models import (
     Rating,
     User,
     Recommendation,
+    UserScores,
 )
 from movie_recommender.init_data.fill_db import check_and_read_data
 from loguru import logger
@@ -28,6 +31,19 @@ from movie_recommender.querying.querying_and_validation import (
 )
 
 from movie_recommender.apps import create_app_slimm
+from movie_recommender.indexes import (
+    RatingMatrix,
+    UserANNIndex,
+    ItemSimilarityTable,
+    FactorModel,
+    CreditIndex,
+    PlotNeighbourTable,
+    MovieCatalog,
+    ModelSnapshot,
+    bump_catalog_version,
+)
+from movie_recommender.recommenders import CombinedRecommender, BatchRecommender
+from movie_recommender.recommenders.dense import rank_dense_scores
 from movie_recommender.querying import CHROMA_Manager
 from loguru import logger
 from movie_recommender.python_queue import BackgroundTaskQueue
@@ -35,6 +51,8 @@ from movie_recommender.background_api.interface import BackgroundInterface
 from flask_user import UserManager
 from cachetools import TTLCache
 from dataclasses import dataclass
+import numpy as np
+import queue
 import json
 import os
 import time
@@ -56,6 +74,9 @@ logger.info(f"We have so many {len(EXAMPLE_MOVIES)} rating movies")
 UNIQUE_GENRES = get_unique_genres(db)
 UNIQUE_GENRES_SET = set(UNIQUE_GENRES.values())
 
+# recommendations are rendered from the catalog instead of Movie objects
+MovieCatalog.get_instance(db)
+
 user_manager = UserManager(app, db, User)  # initialize Flask-User management
 chroma_manager = CHROMA_Manager.get_instance()
 BackgroundTaskQueue.get_instance(timeout=Back_Ground_Timeout)
@@ -65,12 +86,20 @@ logger.info(f"Starting API at {datetime.datetime.now()}")
 
 ACCEPT_BACK_API = False
 
-if BackgroundInterface.check_health(5) and ACCEPT_BACK_API:
+# the process executor runs the jobs itself, uds talks to the background api
+# over a unix socket instead of the port
+BACKGROUND_UDS = BACKGROUND_SOCKET if BACKGROUND_EXECUTOR == "uds" else None
+
+if BACKGROUND_EXECUTOR == "process":
+    logger.info("Background jobs run in a process pool, no background api needed")
+elif BackgroundInterface.check_health(5, BACKGROUND_UDS) and ACCEPT_BACK_API:
     logger.info("background api already started")
 else:
-    logger.info(f"Trying to start Background API at port {BACKGROUND_PORT}")
+    logger.info(
+        f"Trying to start Background API at {BACKGROUND_UDS or f'port {BACKGROUND_PORT}'}"
+    )
     assert BackgroundInterface.start_background_api(
-        30, 2
+        30, 2, BACKGROUND_UDS
     ), "Could not start background api"
 
 
@@ -80,6 +109,9 @@ recommendations_cache = TTLCache(
 
 logger.info(f"Cache started {datetime.datetime.now()}")
 
+# seconds an event stream of /recommendation_events stays open
+RECOMMENDATION_EVENTS_TIMEOUT = 60
+
 
 @dataclass
 class MovieInfo:
@@ -105,6 +137,8 @@ def initdb_command():
     global db
     """Creates the database tables."""
     check_and_read_data(db)
+    # running apis rebuild their in-memory indexes on the next job
+    bump_catalog_version()
     logger.success("Initialized the database.")
 
 
@@ -124,6 +158,105 @@ def initdb_command():
         logger.success("Chroma is full")
 
 
+@app.cli.command("buildannindex")
+def build_ann_index_command():
+    matrix = RatingMatrix.from_db(db)
+    default_vec_val = CombinedRecommender.weights["user_weights"]["default_vec_val"]
+
+    UserANNIndex.build(matrix, default_vec_val).save()
+    logger.success("Built the user ann index, restart the background api to use it.")
+
+
+@app.cli.command("builditemsimilarity")
+def build_item_similarity_command():
+    matrix = RatingMatrix.from_db(db)
+
+    ItemSimilarityTable.build(matrix).save()
+    logger.success(
+        "Built the item similarities, restart the background api to use them."
+    )
+
+
+@app.cli.command("trainfactors")
+def train_factors_command():
+    matrix = RatingMatrix.from_db(db)
+
+    FactorModel.train(matrix).save()
+    logger.success("Trained the factor model, restart the background api to use it.")
+
+
+@app.cli.command("buildplotneighbours")
+def build_plot_neighbours_command():
+    # only movies added to chroma since the last build are computed
+    embeddings = chroma_manager.cache_embeddings()
+    previous = PlotNeighbourTable.load_if_exists()
+
+    PlotNeighbourTable.build(embeddings, previous=previous).save()
+    logger.success("Built the plot neighbours, restart the background api to use them.")
+
+
+@app.cli.command("buildsnapshot")
+def build_snapshot_command():
+    # the catalog and the indexes from sql, the models from their own files
+    snapshot = ModelSnapshot.build(
+        db,
+        CombinedRecommender.weights,
+        ann_index=UserANNIndex.load_if_exists(),
+        item_similarity=ItemSimilarityTable.load_if_exists(),
+        factor_model=FactorModel.load_if_exists(),
+        plot_neighbours=PlotNeighbourTable.load_if_exists(),
+    )
+    snapshot.save()
+    snapshot.publish()
+    logger.success(
+        f"Built model snapshot {snapshot.version}, the background api uses it from its next job on."
+    )
+
+
+@app.cli.command("batchrecommendations")
+def batch_recommendations_command():
+    # recomputes every user with ratings, e.g. after rebuilding the models. In
+    # the bulk lane of the background api when it runs, so the jobs of users
+    # saving their ratings still go first
+    if BACKGROUND_EXECUTOR != "process" and BackgroundInterface.check_health(
+        5, BACKGROUND_UDS
+    ):
+        batch = BackgroundInterface.request_json(
+            "POST", "/batch_recommendations/", 60, BACKGROUND_UDS
+        )
+
+        while batch["state"] in ("waiting", "running"):
+            time.sleep(5)
+            batch = BackgroundInterface.request_json(
+                "GET", f"/batch_recommendations/{batch['batch_id']}", 10, BACKGROUND_UDS
+            )
+            logger.info(f"{batch['users_done']} of {batch['users']} users done")
+
+        logger.info(f"Batch {batch['batch_id']} finished: {batch}")
+        return
+
+    logger.warning("No background api running, recomputing in this process")
+    chroma_manager.cache_embeddings()
+    snapshot = ModelSnapshot.get_current()
+
+    if snapshot is not None:
+        BatchRecommender(CombinedRecommender.from_snapshot(db, snapshot)).run(db)
+        return
+
+    recommender = CombinedRecommender(
+        db,
+        MovieCatalog.get_instance(db),
+        rating_matrix=RatingMatrix.get_instance(db),
+        credit_index=CreditIndex.get_instance(db),
+        ann_index=UserANNIndex.load_if_exists(),
+        item_similarity=ItemSimilarityTable.load_if_exists(),
+        factor_model=FactorModel.load_if_exists(),
+        plot_neighbours=PlotNeighbourTable.load_if_exists(),
+    )
+
+    BatchRecommender(recommender).run(db)
+
+
 # The Home page is accessible to anyone
 @app.route("/")
 def home_page():
@@ -182,33 +315,104 @@ def save_ratings():
     background_task_queue = BackgroundTaskQueue.get_instance()
     print("timeout", background_task_queue.timeout)
 
-    job_id = background_task_queue.add_task(user_id=current_user.id)
-
     # clear chache
     recommendations_cache.pop(current_user.id, None)
 
+    try:
+        job_id = background_task_queue.add_task(user_id=current_user.id)
+    except queue.Full:
+        return (
+            jsonify(
+                {
+                    "error": "Your ratings are saved, but we are busy right now. Please submit them again in a minute."
+                }
+            ),
+            503,
+            {"Retry-After": "60"},
+        )
+
     logger.info(f"Queue started at {job_id}")
+    position, eta = background_task_queue.estimate(job_id)
 
     return jsonify(
-        {"message": "Ratings saved successfully", "recommendation_job_id": job_id}
+        {
+            "message": "Ratings saved successfully",
+            "recommendation_job_id": job_id,
+            "queue_position": position,
+            "eta_seconds": eta,
+        }
     )
 
 
+@app.get("/queue_stats")
+def queue_stats() -> dict[str, object]:
+    return jsonify(BackgroundTaskQueue.get_instance().stats())
+
+
+def job_status(job_id: str) -> dict[str, object]:
+    status = BackgroundTaskQueue.get_instance().task_status.get(job_id)
+
+    if status is None:
+        return {"ok": False, "error": "Job not found"}
+
+    if status.state == "error":
+        return {
+            "ok": False,
+            "error": "Oh now, we have had an error in the background ):",
+        }
+
+    position, eta = BackgroundTaskQueue.get_instance().estimate(job_id)
+
+    return {
+        "ready": status.state == "success",
+        "ok": True,
+        "job": status.to_dict(),
+        "queue_position": position,
+        "eta_seconds": eta,
+    }
+
+
 @app.get("/recommendation_status")
 def recommendation_status() -> dict[str, object]:
     job_id = request.cookies.get("recommendation_job_id")
 
-    status = BackgroundTaskQueue.get_instance().task_status.get(job_id)
+    return jsonify(job_status(job_id))
 
-    if status is None:
-        return jsonify({"ok": False, "error": "Job not found"})
 
-    if status == "error":
-        return jsonify(
-            {"ok": False, "error": "Oh now, we have had an error in the background ):"}
-        )
+@app.get("/recommendation_events")
+def recommendation_events():
+    """server sent events with the job status, sent whenever it changes and
+    closed once the job is done. The browser reconnects after
+    RECOMMENDATION_EVENTS_TIMEOUT."""
+    job_id = request.cookies.get("recommendation_job_id")
+    background_task_queue = BackgroundTaskQueue.get_instance()
+
+    def events():
+        deadline = time.time() + RECOMMENDATION_EVENTS_TIMEOUT
+        last_status, last_sent = None, 0
 
-    return jsonify({"ready": status == "success", "ok": True})
+        while time.time() < deadline:
+            status = job_status(job_id)
+
+            if status != last_status:
+                yield f"data: {json.dumps(status)}\n\n"
+                last_status, last_sent = status, time.time()
+
+                if status.get("ready") or not status["ok"]:
+                    return
+
+            elif time.time() - last_sent > 15:
+                # keeps proxies from closing the idle connection
+                yield ": keep-alive\n\n"
+                last_sent = time.time()
+
+            # woken by the queue workers, the timeout also notices jobs of
+            # other web workers in a shared status store
+            background_task_queue.wait_for_change(1)
+
+    return Response(
+        events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
 
 
 @app.route("/recommendations")
@@ -225,53 +429,69 @@ def recommend_page():
         return "False Args"
     logger.info(f"Selected genres {selected_genres}")
 
-    user = db.session.query(User).get(current_user.id)
+    # only the flag, the user row joins all ratings and recommendations
+    recommendations_ready = (
+        db.session.query(User.recommendations_ready)
+        .filter(User.id == current_user.id)
+        .scalar()
+    )
 
-    if user.recommendations_ready == False:
+    if recommendations_ready == False:
         return render_template("recommendations_loading.html")
 
+    catalog = MovieCatalog.get_instance(db)
+
     if current_user.id in recommendations_cache:
         logger.debug("Loading from Cache")
-        cached_recommendations: list[MovieInfo] = recommendations_cache[current_user.id]
+        positions, cached_recommendations = recommendations_cache[current_user.id]
         logger.debug("Loaded")
 
     else:
-        recommendations = Recommendation.query.filter(
-            Recommendation.user_id == current_user.id
-        ).all()
+        recommendations = (
+            db.session.query(Recommendation.movie_id, Recommendation.score)
+            .filter(Recommendation.user_id == current_user.id)
+            .order_by(Recommendation.score.desc())
+        )
 
+        positions: list[int] = []
         cached_recommendations: list[MovieInfo] = []
 
-        for recommendation in recommendations:
-            score = recommendation.score
-
+        for movie_id, score in recommendations:
             if score < MIN_SCORE:  # keeps cache small
                 continue
 
-            movie = recommendation.movie
-            reco = MovieInfo(
-                title=movie.title,
-                score=score,
-                rounded_score=f"{score*0.01:.2f}",
-                genres=[i.genre for i in movie.genres],
-                tags=[i.tag for i in movie.tags],
-                imdb_link=movie.imdbId_link,
-                id=movie.id,
-                imdbid=movie.imdb_id,
-            )
+            position = catalog.movie_index.get(movie_id)
 
-            cached_recommendations.append(reco)
-
-        # add to chache
-        recommendations_cache[current_user.id] = cached_recommendations
+            if position is None:
+                continue
 
-    response_data = []
+            positions.append(position)
+            cached_recommendations.append(movie_info(catalog, position, score))
 
-    for reco in cached_recommendations:
-        if selected_genres is None or selected_genres.issubset(reco.genres):
-            response_data.append(reco)
+        # add to chache
+        positions = np.array(positions, dtype=np.int32)
+        recommendations_cache[current_user.id] = positions, cached_recommendations
 
-    response_data = response_data[:MAX_RECOMENDATIOSN]
+    if selected_genres is None:
+        response_data = cached_recommendations[:MAX_RECOMENDATIOSN]
+    else:
+        mask = catalog.genre_mask(selected_genres)
+        keep = np.flatnonzero(catalog.with_genres(mask)[positions])
+
+        response_data = [cached_recommendations[i] for i in keep[:MAX_RECOMENDATIOSN]]
+
+        # the stored rows hold a full page for every single genre, combinations
+        # of genres are filtered from the users scores
+        if len(response_data) < MAX_RECOMENDATIOSN and len(selected_genres) > 1:
+            # empty without current scores, then the cached matches stay
+            shown = {movie.id for movie in response_data}
+            response_data += [
+                movie
+                for movie in recommendations_with_genres(current_user.id, mask, catalog)
+                if movie.id not in shown
+            ]
+            response_data.sort(key=lambda movie: movie.score, reverse=True)
+            response_data = response_data[:MAX_RECOMENDATIOSN]
 
     return render_template(
         f"recommendations.html",
@@ -285,6 +505,42 @@ def recommend_page():
     )
 
 
+def movie_info(catalog: MovieCatalog, position: int, score: float) -> MovieInfo:
+    return MovieInfo(
+        title=catalog.titles[position],
+        score=score,
+        rounded_score=f"{score*0.01:.2f}",
+        genres=catalog.genres_of(position),
+        tags=catalog.tags_of(position),
+        imdb_link=catalog.imdb_links[position],
+        id=int(catalog.movie_ids[position]),
+        imdbid=catalog.imdb_ids[position],
+    )
+
+
+def recommendations_with_genres(
+    user_id: int, mask: np.uint64, catalog: MovieCatalog
+) -> list[MovieInfo]:
+    """the best movies with all genres of the mask from the stored scores"""
+    user_scores = db.session.get(UserScores, user_id)
+
+    if user_scores is None or user_scores.catalog_version != catalog.catalog_version:
+        return []
+
+    scores = np.frombuffer(user_scores.scores, dtype=np.float32)
+    scores = np.where(catalog.with_genres(mask), scores, 0)
+
+    positions, scores = rank_dense_scores(
+        scores, np.zeros(0, dtype=np.int32), MAX_RECOMENDATIOSN
+    )
+
+    return [
+        movie_info(catalog, position, float(score))
+        for position, score in zip(positions, scores)
+        if score >= MIN_SCORE
+    ]
+
+
 # Start development web server
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
@@ -2,6 +2,8 @@
 from movie_recommender import REPO_PATH
 from flask import Flask
 from movie_recommender.querying.sql_models import db, User
+from movie_recommender.querying import CHROMA_Manager
+from flask_user import UserManager
 import os
 import celery
 from celery import Celery
@@ -1,15 +1,36 @@
-from fastapi import FastAPI, status
+from fastapi import FastAPI, HTTPException, status
 from loguru import logger
 import time
 from movie_recommender import REPO_PATH
 import os
-from pydantic import BaseModel
-from movie_recommender.querying.sql_models import Rating, Recommendation, User
-from movie_recommender.recommenders import CombinedRecommender
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional, Tuple
+from movie_recommender.recommenders import BatchRecommender
+from movie_recommender.indexes import ModelSnapshot
+from movie_recommender.background_api import jobs
+from movie_recommender.background_api.workers import PreforkedWorkers
+from movie_recommender.background_api.jobs import (
+    build_recommender,
+    generate_recommendations,
+)
 import datetime
 from movie_recommender import REPO_PATH
 from loguru import logger
 from movie_recommender.apps import create_app_slimm
+from movie_recommender.querying.sql_models import Recommendation
+from movie_recommender.python_queue.status_store import MemoryStatusStore
+from movie_recommender.python_queue.scheduler import JobScheduler, LANES
+from movie_recommender import (
+    BACKGROUND_WORKERS,
+    BACKGROUND_PROCESSES,
+    JOB_STATUS_TTL,
+    MAX_RECOMENDATIOSN,
+)
+from cachetools import TTLCache
+from sqlalchemy.orm import sessionmaker
+import threading
+import queue
+import uuid
 
 os.chdir(REPO_PATH)
 
@@ -23,63 +44,53 @@ logger.debug("some debug bessame")
 app, db = create_app_slimm()
 logger.debug("another")
 
+jobs.load_models(db)
 
-def generate_recommendations(db, user_id):
-    logger.debug(f"Received Job for user {user_id}")
-
-    try:
-        user = db.session.query(User).get(user_id)
-        if user is None:
-            message = f"User with ID {user_id} not found."
-
-            logger.error(message)
-
-        user.recommendations_ready = False
-        db.session.commit()
-
-        db.session.query(Recommendation).filter_by(user_id=user_id).delete()
-        db.session.commit()
+# forked only now, so the workers share the loaded models
+workers = PreforkedWorkers(db) if BACKGROUND_PROCESSES > 0 else None
 
-        ratings = db.session.query(Rating).filter_by(user_id=user_id).all()
+# every job runs on the job threads instead of inside its request. The ones
+# of the web app are interactive, batches and /jobs/batch/ wait in the bulk
+# lane behind them
+job_scheduler = JobScheduler()
+job_status = MemoryStatusStore()
+job_lock = threading.Lock()
+# job id -> user id of the submitted jobs
+job_users = TTLCache(100_000, JOB_STATUS_TTL)
+# user id -> (job id, lane) of the jobs that have not started yet
+waiting_jobs = {}
+# job id -> event set once the job is done, until then
+job_done = {}
 
-        if not ratings:
-            message = f"No ratings found for user ID {user_id}."
-            logger.error(message)
+# users per bulk job of /batch_recommendations/
+BATCH_CHUNK_USERS = 256
+# batch id -> BatchProgress
+batches = TTLCache(1000, JOB_STATUS_TTL)
 
-        movies, ratings = zip(*[(r.movie, r.value) for r in ratings])
-        ratings = [(val - 3) ** 3 for val in ratings]
 
-        logger.debug("Start recommender")
+@background_api.on_event("shutdown")
+def stop_workers() -> None:
+    job_scheduler.close()
 
-        recommender = CombinedRecommender(db)
-        recommendations, scores = recommender.find_most_simmilar(movies, ratings)
+    if workers is not None:
+        workers.close()
 
-        logger.debug("Start computed recommendations")
-
-        for movie, score in zip(recommendations, scores):
-            new_recommendation = Recommendation(
-                user_id=user_id, movie_id=movie.id, score=float(score), movie=movie
-            )
-            db.session.add(new_recommendation)
-
-        user.recommendations_ready = True
-        logger.success(f"Finished User {user_id}")
-        db.session.commit()
-        db.session.close()
-        return True
-    except Exception as e:
-        message = f"Error generating recommendations: {e}"
-        logger.error(message)
-        logger.exception(message)
-        db.session.close()
 
-    return False
+def run_recommendations(user_id: int) -> str:
+    """in one of the forked workers if there are any, in this thread else"""
+    if workers is not None:
+        return workers.run(user_id)
+    return generate_recommendations(db, user_id)
 
 
 class HealthCheck(BaseModel):
     """Response model to validate and return when performing a health check."""
 
+    # model_version is not a pydantic name
+    model_config = ConfigDict(protected_namespaces=())
+
     status: str = "OK"
+    model_version: Optional[str] = None
 
 
 @background_api.get(
@@ -102,11 +113,342 @@ def get_health() -> HealthCheck:
     """
     logger.debug("received health request")
 
-    return HealthCheck(status="OK")
+    snapshot = ModelSnapshot.get_current()
+    return HealthCheck(
+        status="OK", model_version=snapshot.version if snapshot is not None else None
+    )
 
 
 @background_api.post("/calculate_recommendations/")
-def api_fix_spelling(user_id: int) -> bool:
+def api_fix_spelling(user_id: int) -> str:
+    """the result of the job, success, error or superseded"""
     logger.debug(f"received job for user {user_id}")
 
-    return generate_recommendations(db, user_id)
+    # in the interactive lane, ahead of every bulk job
+    try:
+        job_id, done = submit_job(user_id, "interactive")
+    except queue.Full:
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE, "The interactive lane is full"
+        )
+
+    done.wait()
+    return job_status.get(job_id).state
+
+
+class BatchProgress(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    batch_id: str
+    state: str
+    users: int
+    users_done: int = 0
+    chunks: int
+    chunks_done: int = 0
+    failed_chunks: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    seconds: Optional[float] = None
+    users_per_second: Optional[float] = None
+    model_version: str
+
+
+def submit_batch(user_ids: Optional[List[int]]) -> BatchProgress:
+    """queues the users in chunks of BATCH_CHUNK_USERS in the bulk lane"""
+    if user_ids is None:
+        user_ids = BatchRecommender.rated_users(db)
+        db.session.close()
+
+    # the whole batch uses one model version
+    recommender = build_recommender(db, parallel=False)
+    chunks = [
+        user_ids[start : start + BATCH_CHUNK_USERS]
+        for start in range(0, len(user_ids), BATCH_CHUNK_USERS)
+    ]
+
+    progress = BatchProgress(
+        batch_id=uuid.uuid4().hex,
+        state="waiting",
+        users=len(user_ids),
+        chunks=len(chunks),
+        model_version=recommender.model_version,
+    )
+    batches[progress.batch_id] = progress
+
+    for number, chunk in enumerate(chunks):
+        try:
+            job_scheduler.put_nowait(
+                (run_batch_chunk, (progress, recommender, chunk)), "bulk"
+            )
+        except queue.Full:
+            logger.warning(
+                f"The bulk lane is full, dropped {len(chunks) - number} chunks of batch {progress.batch_id}"
+            )
+            with job_lock:
+                progress.failed_chunks += len(chunks) - number
+            break
+
+    finish_batch_chunk(progress)
+    return progress
+
+
+def run_batch_chunk(progress: BatchProgress, recommender, user_ids: List[int]) -> None:
+    with job_lock:
+        if progress.started_at is None:
+            progress.state = "running"
+            progress.started_at = time.time()
+
+    try:
+        users = BatchRecommender(recommender).run(db, user_ids, len(user_ids))
+    except Exception as e:
+        logger.error(f"Chunk of batch {progress.batch_id} failed: {e}")
+        users = None
+    finally:
+        db.session.close()
+
+    with job_lock:
+        if users is None:
+            progress.failed_chunks += 1
+        else:
+            progress.chunks_done += 1
+            progress.users_done += users
+
+    finish_batch_chunk(progress)
+
+
+def finish_batch_chunk(progress: BatchProgress) -> None:
+    with job_lock:
+        if progress.finished_at is not None:
+            return
+        if progress.chunks_done + progress.failed_chunks < progress.chunks:
+            return
+
+        progress.state = "error" if progress.failed_chunks else "success"
+        progress.finished_at = time.time()
+        progress.started_at = progress.started_at or progress.finished_at
+
+
+def batch_progress(progress: BatchProgress) -> BatchProgress:
+    if progress.started_at is None:
+        return progress
+
+    seconds = (progress.finished_at or time.time()) - progress.started_at
+    return progress.model_copy(
+        update={
+            "seconds": seconds,
+            "users_per_second": progress.users_done / max(seconds, 1e-9),
+        }
+    )
+
+
+@background_api.post(
+    "/batch_recommendations/",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=BatchProgress,
+)
+def batch_recommendations(user_ids: Optional[List[int]] = None) -> BatchProgress:
+    """recomputes the given users, or everyone with ratings, in the bulk lane.
+    Poll /batch_recommendations/{batch_id} for the progress."""
+    logger.debug(f"received batch job for {len(user_ids) if user_ids else 'all'} users")
+    return batch_progress(submit_batch(user_ids))
+
+
+@background_api.get("/batch_recommendations/{batch_id}", response_model=BatchProgress)
+def get_batch(batch_id: str) -> BatchProgress:
+    progress = batches.get(batch_id)
+
+    if progress is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Unknown batch {batch_id}")
+
+    return batch_progress(progress)
+
+
+class JobSubmitted(BaseModel):
+    job_id: str
+    user_id: int
+
+
+class JobRecord(BaseModel):
+    job_id: str
+    user_id: int
+    state: str
+    queued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    duration: Optional[float] = None
+    error: Optional[str] = None
+
+
+class JobResult(BaseModel):
+    job: JobRecord
+    movie_ids: List[int] = []
+    scores: List[float] = []
+
+
+def submit_job(user_id: int, lane: str = "interactive") -> Tuple[str, threading.Event]:
+    """queues the job of the user, a job of the user that has not started yet
+    takes the new request as it reads the newest ratings anyway. Returns the
+    job id and the event set once it is done, raises queue.Full when the lane
+    is full."""
+    with job_lock:
+        if user_id in waiting_jobs:
+            job_id, waiting_lane = waiting_jobs[user_id]
+
+            if LANES.index(lane) < LANES.index(waiting_lane):
+                # queued again, whichever copy starts first runs the job
+                try:
+                    job_scheduler.put_nowait((run_job, (job_id, user_id)), lane)
+                    waiting_jobs[user_id] = job_id, lane
+                except queue.Full:
+                    pass
+
+            return job_id, job_done[job_id]
+
+        job_id = uuid.uuid4().hex
+        job_scheduler.put_nowait((run_job, (job_id, user_id)), lane)
+
+        waiting_jobs[user_id] = job_id, lane
+        job_users[job_id] = user_id
+        job_done[job_id] = threading.Event()
+        job_status.update(job_id, "waiting")
+
+        return job_id, job_done[job_id]
+
+
+def run_job(job_id: str, user_id: int) -> None:
+    with job_lock:
+        if waiting_jobs.get(user_id, (None,))[0] != job_id:
+            # the copy in the other lane of a promoted job ran already
+            return
+
+        del waiting_jobs[user_id]
+
+    job_status.update(job_id, "running")
+
+    try:
+        result = run_recommendations(user_id)
+    except Exception as e:
+        logger.error(f"Job {job_id} of user {user_id} failed: {e}")
+        result = "error"
+
+    try:
+        if result == "error":
+            job_status.update(job_id, "error", "Generating the recommendations failed")
+        else:
+            job_status.update(job_id, result)
+    finally:
+        with job_lock:
+            done = job_done.pop(job_id)
+        done.set()
+
+
+def job_worker() -> None:
+    # threads start without the app context of the main thread, db.engine and
+    # db.session need one
+    with app.app_context():
+        while True:
+            lane, job = job_scheduler.get()
+            if lane is None:
+                return
+
+            function, args = job
+
+            try:
+                function(*args)
+            except Exception as e:
+                logger.error(f"Background job {function.__name__} failed: {e}")
+            finally:
+                job_scheduler.task_done(lane)
+
+
+job_threads = [
+    threading.Thread(target=job_worker, name=f"job-{i}", daemon=True)
+    for i in range(max(BACKGROUND_WORKERS, BACKGROUND_PROCESSES))
+]
+for job_thread in job_threads:
+    job_thread.start()
+
+
+def submit_or_503(user_id: int, lane: str) -> JobSubmitted:
+    try:
+        job_id, _ = submit_job(user_id, lane)
+        return JobSubmitted(job_id=job_id, user_id=user_id)
+    except queue.Full:
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            f"The {lane} lane is full",
+            headers={"Retry-After": "5"},
+        )
+
+
+def job_record(job_id: str) -> JobRecord:
+    record = job_status.get(job_id)
+    user_id = job_users.get(job_id)
+
+    if record is None or user_id is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Unknown job {job_id}")
+
+    return JobRecord(job_id=job_id, user_id=user_id, **record.to_dict())
+
+
+@background_api.post(
+    "/jobs/",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobSubmitted,
+)
+def submit_recommendations(user_id: int) -> JobSubmitted:
+    """like /calculate_recommendations/ but answers right away, poll
+    /jobs/{job_id} for the status"""
+    logger.debug(f"received job submission for user {user_id}")
+    return submit_or_503(user_id, "interactive")
+
+
+@background_api.post(
+    "/jobs/batch/",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=List[JobSubmitted],
+)
+def submit_many_recommendations(user_ids: List[int]) -> List[JobSubmitted]:
+    """queued in the bulk lane, the single jobs go first"""
+    logger.debug(f"received job submissions for {len(user_ids)} users")
+    return [submit_or_503(user_id, "bulk") for user_id in user_ids]
+
+
+@background_api.get("/jobs/stats")
+def get_job_stats() -> dict:
+    """depth, running jobs and waiting times of each lane"""
+    return job_scheduler.stats()
+
+
+@background_api.get("/jobs/{job_id}", response_model=JobRecord)
+def get_job(job_id: str) -> JobRecord:
+    return job_record(job_id)
+
+
+@background_api.get("/jobs/{job_id}/result", response_model=JobResult)
+def get_job_result(job_id: str) -> JobResult:
+    """the best recommendations once the job succeeded, only the record
+    before"""
+    record = job_record(job_id)
+
+    if record.state != "success":
+        return JobResult(job=record)
+
+    session = sessionmaker(bind=db.engine)()
+
+    try:
+        rows = (
+            session.query(Recommendation.movie_id, Recommendation.score)
+            .filter_by(user_id=record.user_id)
+            .order_by(Recommendation.score.desc())
+            .limit(MAX_RECOMENDATIOSN)
+            .all()
+        )
+    finally:
+        session.close()
+
+    return JobResult(
+        job=record,
+        movie_ids=[row[0] for row in rows],
+        scores=[row[1] for row in rows],
+    )
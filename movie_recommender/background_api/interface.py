@@ -8,7 +8,10 @@ from subprocess import Popen, PIPE
 import threading
 import queue
 import sys
+import os
 import socket
+import http.client
+import json
 
 
 def is_port_available(port) -> bool:
@@ -47,10 +50,32 @@ def get_stderr_text(process: Popen, wait_time: int) -> str:
     return "".join(stderr_output)
 
 
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """http over the unix domain socket of uvicorn --uds"""
+
+    def __init__(self, socket_path, timeout=None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = str(socket_path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
 class BackgroundInterface:
     @staticmethod
-    def start_background_api(waiting=10, timeout=2) -> bool:
-        if not is_port_available(BACKGROUND_PORT):
+    def start_background_api(waiting=10, timeout=2, uds=None) -> bool:
+        """with uds the api listens on that unix socket instead of the port"""
+        if uds is not None and os.path.exists(uds):
+            if BackgroundInterface.check_health(timeout, uds):
+                logger.error(f"Another background api listens on {uds}!")
+                return False
+
+            # left behind by a background api that was killed
+            os.remove(uds)
+
+        if uds is None and not is_port_available(BACKGROUND_PORT):
             logger.error(
                 f"The BACKGROUND_PORT {BACKGROUND_PORT} is not free, choose another in the .env!"
             )
@@ -63,12 +88,13 @@ class BackgroundInterface:
             "-m",
             "uvicorn",
             "api:background_api",
-            "--host",
-            "0.0.0.0",
-            "--port",
-            BACKGROUND_PORT,
         ]
 
+        if uds is None:
+            cmd += ["--host", "0.0.0.0", "--port", BACKGROUND_PORT]
+        else:
+            cmd += ["--uds", uds]
+
         cmd = [str(i) for i in cmd]
 
         try:
@@ -83,7 +109,7 @@ class BackgroundInterface:
 
             while time.time() - start < waiting:
                 try:
-                    if BackgroundInterface.check_health(timeout):
+                    if BackgroundInterface.check_health(timeout, uds):
                         std_err_output = get_stderr_text(process, 1)
                         logger.debug(
                             f"The Uvicorn startup outputs: \n {std_err_output}"
@@ -101,24 +127,64 @@ class BackgroundInterface:
             return False
 
     @staticmethod
-    def check_health(timeout) -> bool:
+    def check_health(timeout, uds=None) -> bool:
         try:
             start = time.time()
-            endpoint = f"http://localhost:{BACKGROUND_PORT}/health/"
 
-            response = requests.get(endpoint, timeout=timeout)
+            if uds is not None:
+                connection = UnixHTTPConnection(uds, timeout)
+                connection.request("GET", "/health")
+                status = connection.getresponse().status
+                connection.close()
 
-            # Raise an HTTPError for bad requests
-            response.raise_for_status()
-            logger.success(
-                f"Received {response.status_code} - Took {time.time() -start :.4f}"
-            )
+                if status != 200:
+                    raise Exception(f"Received {status}")
+            else:
+                endpoint = f"http://localhost:{BACKGROUND_PORT}/health/"
+
+                response = requests.get(endpoint, timeout=timeout)
+
+                # Raise an HTTPError for bad requests
+                response.raise_for_status()
+                status = response.status_code
+
+            logger.success(f"Received {status} - Took {time.time() -start :.4f}")
             return True
         except Exception as e:
             return False
 
     @staticmethod
-    def commit_job(user_id: int, timeout: float) -> bool:
+    def request_json(method: str, path: str, timeout: float, uds=None, body=None):
+        """the json answer of the background api to a request"""
+        if uds is not None:
+            connection = UnixHTTPConnection(uds, timeout)
+        else:
+            connection = http.client.HTTPConnection(
+                "localhost", BACKGROUND_PORT, timeout=timeout
+            )
+
+        try:
+            if body is None:
+                connection.request(method, path)
+            else:
+                connection.request(
+                    method,
+                    path,
+                    json.dumps(body),
+                    {"Content-Type": "application/json"},
+                )
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+
+        if response.status >= 400:
+            raise Exception(f"Background api answered {response.status}: {data}")
+
+        return json.loads(data)
+
+    @staticmethod
+    def commit_job(user_id: int, timeout: float) -> str:
         response = requests.post(
             f"http://localhost:{BACKGROUND_PORT}/calculate_recommendations/?user_id={user_id}",
             timeout=timeout,
@@ -0,0 +1,185 @@
+from movie_recommender.querying.sql_models import (
+    Rating,
+    Recommendation,
+    User,
+    UserScores,
+)
+from movie_recommender.recommenders import CombinedRecommender, RecommenderState
+from movie_recommender.recommenders.dense import stored_recommendations, score_blob
+from movie_recommender.indexes import (
+    RatingMatrix,
+    UserANNIndex,
+    ItemSimilarityTable,
+    FactorModel,
+    CreditIndex,
+    PlotNeighbourTable,
+    MovieCatalog,
+    ModelSnapshot,
+)
+from movie_recommender.querying import CHROMA_Manager
+from movie_recommender import RECOMMENDATIONS_CACHED_N_USERS
+from sqlalchemy.orm import sessionmaker
+from cachetools import LRUCache
+from typing import List, Tuple
+from hashlib import sha256
+from loguru import logger
+import threading
+
+# The recommendation job of the background api. Importing this module has no
+# side effects, so the in process executor runs the same job in its worker
+# processes after load_models.
+
+# the optional models, set by load_models
+ann_index: UserANNIndex = None
+item_similarity: ItemSimilarityTable = None
+factor_model: FactorModel = None
+plot_neighbours: PlotNeighbourTable = None
+
+# component scores of the last job per user, re-rating only adds the change
+user_states = LRUCache(RECOMMENDATIONS_CACHED_N_USERS)
+user_states_lock = threading.Lock()
+
+
+def load_models(db) -> None:
+    """prepares this process for jobs, once at startup"""
+    global ann_index, item_similarity, factor_model, plot_neighbours
+
+    # a published model snapshot is memory mapped in milliseconds, without one
+    # the indexes are built once and rebuilt by get_instance after 'flask initdb'
+    if ModelSnapshot.get_current() is None:
+        MovieCatalog.get_instance(db)
+        RatingMatrix.get_instance(db)
+        CreditIndex.get_instance(db)
+
+    ann_index = UserANNIndex.load_if_exists()
+    item_similarity = ItemSimilarityTable.load_if_exists()
+    factor_model = FactorModel.load_if_exists()
+    plot_neighbours = PlotNeighbourTable.load_if_exists()
+
+    # plot neighbours come from the memory mapped embeddings instead of chroma
+    CHROMA_Manager.get_instance().cache_embeddings()
+
+
+def build_recommender(db, parallel=True) -> CombinedRecommender:
+    """from the current model snapshot, so a new one is used by the next job
+    without a restart"""
+    snapshot = ModelSnapshot.get_current()
+
+    if snapshot is not None:
+        return CombinedRecommender.from_snapshot(db, snapshot, parallel=parallel)
+
+    return CombinedRecommender(
+        db,
+        MovieCatalog.get_instance(db),
+        rating_matrix=RatingMatrix.get_instance(db),
+        credit_index=CreditIndex.get_instance(db),
+        ann_index=ann_index,
+        item_similarity=item_similarity,
+        factor_model=factor_model,
+        plot_neighbours=plot_neighbours,
+        parallel=parallel,
+    )
+
+
+def user_ratings(session, user_id: int) -> List[Tuple[int, float]]:
+    return (
+        session.query(Rating.movie_id, Rating.value)
+        .filter_by(user_id=user_id)
+        .order_by(Rating.movie_id)
+        .all()
+    )
+
+
+def ratings_fingerprint(ratings: List[Tuple[int, float]]) -> str:
+    return sha256(repr([tuple(rating) for rating in ratings]).encode()).hexdigest()
+
+
+def generate_recommendations(db, user_id) -> str:
+    """success, error or superseded when the user saved new ratings while
+    the job ran and nothing was written"""
+    logger.debug(f"Received Job for user {user_id}")
+    # several jobs run at once and the flask session is shared by every
+    # thread, so each job opens its own
+    session = sessionmaker(bind=db.engine)()
+
+    try:
+        user = session.query(User).get(user_id)
+        if user is None:
+            message = f"User with ID {user_id} not found."
+
+            logger.error(message)
+
+        user.recommendations_ready = False
+        session.commit()
+
+        ratings = user_ratings(session, user_id)
+        fingerprint = ratings_fingerprint(ratings)
+
+        if not ratings:
+            message = f"No ratings found for user ID {user_id}."
+            logger.error(message)
+
+        # the whole job uses one model version, even if a new one is published
+        recommender = build_recommender(db)
+        catalog = recommender.catalog
+
+        # catalog positions instead of Movie objects
+        movies, ratings = catalog.rated(*zip(*ratings))
+        ratings = (ratings - 3) ** 3
+
+        logger.debug(f"Start recommender with model {recommender.model_version}")
+
+        # popped so two jobs of one user never share a state
+        with user_states_lock:
+            state = user_states.pop(user_id, None)
+
+        if state is None or state.model_version != recommender.model_version:
+            state = RecommenderState(recommender.model_version)
+
+        totals = recommender.score(movies, ratings, state=state)
+        with user_states_lock:
+            user_states[user_id] = state
+
+        logger.debug("Start computed recommendations")
+
+        # every single genre filter gets a full page from the stored rows
+        recommendations = stored_recommendations(totals, movies, catalog)
+
+        if ratings_fingerprint(user_ratings(session, user_id)) != fingerprint:
+            # the user saved new ratings meanwhile, whoever queued this job
+            # has to run one for them
+            logger.info(f"Discarded the superseded job of user {user_id}")
+            session.close()
+            return "superseded"
+
+        session.query(Recommendation).filter_by(user_id=user_id).delete()
+        session.add_all(
+            Recommendation(user_id=user_id, movie_id=int(movie_id), score=float(score))
+            for movie_id, score in zip(
+                catalog.movie_ids[recommendations], totals[recommendations]
+            )
+        )
+
+        # genre combinations are filtered from all scores by the web api
+        session.merge(
+            UserScores(
+                user_id=user_id,
+                catalog_version=catalog.catalog_version,
+                scores=score_blob(totals, movies),
+            )
+        )
+
+        user.recommendations_ready = True
+        logger.success(
+            f"Finished User {user_id} with model {recommender.model_version}"
+        )
+        session.commit()
+        session.close()
+        return "success"
+    except Exception as e:
+        message = f"Error generating recommendations: {e}"
+        logger.error(message)
+        logger.exception(message)
+        session.close()
+
+    return "error"
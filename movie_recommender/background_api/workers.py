@@ -0,0 +1,65 @@
+from movie_recommender import BACKGROUND_PROCESSES
+from movie_recommender.background_api import jobs
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+import multiprocessing
+import time
+import gc
+import os
+
+# the db of the forked workers, inherited from the background api
+_worker_db = None
+
+
+def _init_worker():
+    # the pooled connections belong to the parent, a connection used by two
+    # processes at once corrupts both
+    _worker_db.engine.dispose(close=False)
+    logger.debug(f"Forked job worker {os.getpid()}")
+
+
+def _run_in_worker(user_id: int) -> str:
+    return jobs.generate_recommendations(_worker_db, user_id)
+
+
+class PreforkedWorkers:
+    """Job processes forked from the background api once load_models is done.
+
+    The catalog, rating matrix, indexes and embeddings are loaded once by the
+    api, the workers share their pages copy-on-write instead of each holding
+    a copy. Jobs wait in one queue that every idle worker takes the next one
+    from, so the jobs spread over all cores.
+
+    A model snapshot published later is loaded by every worker on its next
+    job. Its arrays, the sparse matrices included, stay memory mapped, so the
+    workers share them through the page cache. Only the per movie lookups,
+    like the titles of the catalog, are copied into each worker.
+    """
+
+    def __init__(self, db, processes: int = BACKGROUND_PROCESSES) -> None:
+        global _worker_db
+        _worker_db = db
+        self.processes = processes
+        start = time.time()
+
+        # the loaded objects leave the garbage collector's generations, else
+        # its first run in a worker writes to all their pages and copies them
+        gc.collect()
+        gc.freeze()
+
+        self.pool = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+        )
+        # a fork pool starts all its workers with the first job, now while
+        # the api has no other threads that could hold a lock
+        self.pool.submit(int).result()
+
+        logger.info(f"Forked {processes} job workers in {time.time() - start:.2f}s")
+
+    def run(self, user_id: int) -> bool:
+        return self.pool.submit(_run_in_worker, user_id).result()
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
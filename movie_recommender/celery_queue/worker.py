@@ -4,6 +4,7 @@ from movie_recommender.recommenders.content_based_recommender import (
     ContentBasedRecommender,
 )
 from movie_recommender.recommenders.user_based_recommender import UserBasedRecommender
+from movie_recommender.indexes import MovieCatalog
 import time
 from movie_recommender.apps import celery_app, db
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -38,25 +39,30 @@ def generate_recommendations(user_id):
         session.query(Recommendation).filter_by(user_id=user_id).delete()
         session.commit()
 
-        ratings = session.query(Rating).filter_by(user_id=user_id).all()
+        ratings = (
+            session.query(Rating.movie_id, Rating.value)
+            .filter_by(user_id=user_id)
+            .all()
+        )
 
         if not ratings:
             celery_logger.info(f"No ratings found for user ID {user_id}.")
             raise Exception()
 
-        movies, ratings = zip(*[(r.movie, r.value) for r in ratings])
-        ratings = [(val - 3) ** 3 for val in ratings]
+        catalog = MovieCatalog.get_instance(db)
+
+        movies, ratings = catalog.rated(*zip(*ratings))
+        ratings = (ratings - 3) ** 3
 
         start = time.time()
-        recommender = ContentBasedRecommender()
+        recommender = ContentBasedRecommender(catalog)
         recommendations, scores = recommender.find_most_simmilar(movies, ratings)
 
         celery_logger.info(f"Recommendation took {time.time() - start}")
 
-        for movie, score in zip(recommendations, scores):
-            movie = session.merge(movie)
+        for movie_id, score in zip(catalog.movie_ids[recommendations], scores):
             new_recommendation = Recommendation(
-                user_id=user_id, movie_id=movie.id, score=float(score), movie=movie
+                user_id=user_id, movie_id=int(movie_id), score=float(score)
             )
             session.add(new_recommendation)
 
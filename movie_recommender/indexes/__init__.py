@@ -0,0 +1,10 @@
+from .rating_matrix import RatingMatrix, load_movie_ids
+from .user_ann_index import UserANNIndex
+from .item_similarity import ItemSimilarityTable
+from .factor_model import FactorModel
+from .credit_index import CreditIndex
+from .versioning import catalog_version, bump_catalog_version
+from .plot_embeddings import PlotEmbeddingMatrix
+from .plot_neighbours import PlotNeighbourTable
+from .movie_catalog import MovieCatalog
+from .snapshot import ModelSnapshot
@@ -0,0 +1,267 @@
+from movie_recommender.querying.sql_models import movie_actors, movie_directors
+from movie_recommender.indexes.rating_matrix import load_movie_ids, positions_of
+from movie_recommender.indexes.versioning import CatalogIndex
+from scipy import sparse
+from loguru import logger
+from typing import Dict, List, Tuple, Union
+import numpy as np
+import time
+
+
+def _csr(
+    rows: np.ndarray, cols: np.ndarray, n_rows: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """offsets and neighbours of a bipartite edge list, neighbours of row i are
+    neighbours[offsets[i]:offsets[i + 1]] in ascending order"""
+    order = np.lexsort((cols, rows))
+    offsets = np.zeros(n_rows + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=offsets[1:])
+    return offsets, cols[order].astype(np.int32)
+
+
+class _Bipartite:
+    """movies <-> people (actors or directors) in both directions"""
+
+    # every array of it, saved by CreditIndex.arrays
+    names = (
+        "person_ids",
+        "movie_offsets",
+        "movie_people",
+        "person_offsets",
+        "person_movies",
+    )
+
+    def __init__(self, movie_pos: np.ndarray, person_ids: np.ndarray, n_movies: int):
+        self.person_ids = np.unique(person_ids).astype(np.int32)
+        person_pos = np.searchsorted(self.person_ids, person_ids).astype(np.int32)
+
+        self.movie_offsets, self.movie_people = _csr(movie_pos, person_pos, n_movies)
+        self.person_offsets, self.person_movies = _csr(
+            person_pos, movie_pos, len(self.person_ids)
+        )
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "_Bipartite":
+        bipartite = cls.__new__(cls)
+        for name in cls.names:
+            setattr(bipartite, name, arrays[name])
+        return bipartite
+
+    def people_of(self, movie: int) -> np.ndarray:
+        return self.movie_people[
+            self.movie_offsets[movie] : self.movie_offsets[movie + 1]
+        ]
+
+    def movies_of(self, person: int) -> np.ndarray:
+        return self.person_movies[
+            self.person_offsets[person] : self.person_offsets[person + 1]
+        ]
+
+    def edges(self, movie_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(movie ids, person ids) of every link, the input of CreditIndex"""
+        movies = np.repeat(np.arange(len(movie_ids)), np.diff(self.movie_offsets))
+        return movie_ids[movies], self.person_ids[self.movie_people]
+
+    def incidence(self, first_only=False) -> sparse.csr_matrix:
+        """movies x people 0/1 matrix, with first_only just the first person of
+        every movie"""
+        n_movies = len(self.movie_offsets) - 1
+        counts = np.diff(self.movie_offsets)
+
+        if first_only:
+            rows = np.flatnonzero(counts).astype(np.int32)
+            cols = self.movie_people[self.movie_offsets[rows]]
+        else:
+            rows = np.repeat(np.arange(n_movies, dtype=np.int32), counts)
+            cols = self.movie_people
+
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(n_movies, len(self.person_ids)),
+        )
+
+
+class CreditIndex(CatalogIndex):
+    """Which actors and directors worked on which movie, as int32 CSR arrays.
+
+    Movies are addressed by their position in movie_ids, actors and directors
+    by their position in actors.person_ids / directors.person_ids. Built once
+    from movie_actors and movie_directors and rebuilt after 'flask initdb'.
+    """
+
+    # the incidence matrices and the people they have as columns
+    matrices = {
+        "actor_matrix": "actors",
+        "director_matrix": "directors",
+        "first_director_matrix": "directors",
+    }
+
+    def __init__(
+        self,
+        movie_ids: np.ndarray,
+        actor_edges: Tuple[np.ndarray, np.ndarray],
+        director_edges: Tuple[np.ndarray, np.ndarray],
+    ) -> None:
+        """movie_ids are sorted, edges are (movie ids, person ids) arrays of the
+        link tables"""
+        self.movie_ids = movie_ids
+
+        actors = self._bipartite(*actor_edges)
+        directors = self._bipartite(*director_edges)
+
+        self._set_parts(
+            actors,
+            directors,
+            actor_matrix=actors.incidence(),
+            director_matrix=directors.incidence(),
+            first_director_matrix=directors.incidence(first_only=True),
+        )
+
+    def _set_parts(self, actors: _Bipartite, directors: _Bipartite, **matrices) -> None:
+        self.actors = actors
+        self.directors = directors
+
+        # for the sparse scoring in actor_scores and director_scores
+        self.actor_matrix = matrices["actor_matrix"]
+        self.director_matrix = matrices["director_matrix"]
+        self.first_director_matrix = matrices["first_director_matrix"]
+        self.actor_counts = np.diff(actors.movie_offsets).astype(np.float32)
+        self.has_director = (np.diff(directors.movie_offsets) > 0).astype(np.float32)
+
+    def _bipartite(self, movie_ids: np.ndarray, person_ids: np.ndarray) -> _Bipartite:
+        # links to movies that are not in the movies table are dropped
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+
+        pos = np.searchsorted(self.movie_ids, movie_ids)
+        pos = np.minimum(pos, len(self.movie_ids) - 1)
+        known = self.movie_ids[pos] == movie_ids
+
+        return _Bipartite(pos[known], person_ids[known], len(self.movie_ids))
+
+    @classmethod
+    def from_db(cls, db) -> "CreditIndex":
+        start = time.time()
+
+        movie_ids = load_movie_ids(db)
+
+        actor_edges = db.session.query(
+            movie_actors.c.movie_id, movie_actors.c.actor_id
+        ).all()
+        director_edges = db.session.query(
+            movie_directors.c.movie_id, movie_directors.c.director_id
+        ).all()
+
+        index = cls(
+            movie_ids,
+            cls._columns(actor_edges),
+            cls._columns(director_edges),
+        )
+
+        logger.info(
+            f"Built credit index with {len(actor_edges)} actor and {len(director_edges)} director links in {time.time() - start:.2f}s"
+        )
+        return index
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """the built arrays, so from_arrays only wraps them"""
+        arrays = {"movie_ids": self.movie_ids}
+
+        for people in ("actors", "directors"):
+            for name in _Bipartite.names:
+                arrays[f"{people}_{name}"] = getattr(getattr(self, people), name)
+
+        for name in self.matrices:
+            matrix = getattr(self, name)
+            arrays[f"{name}_data"] = matrix.data
+            arrays[f"{name}_indices"] = matrix.indices
+            arrays[f"{name}_indptr"] = matrix.indptr
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "CreditIndex":
+        if "actor_movie_ids" in arrays:
+            # older files hold the edges, the index is built from them
+            return cls(
+                arrays["movie_ids"],
+                (arrays["actor_movie_ids"], arrays["actor_ids"]),
+                (arrays["director_movie_ids"], arrays["director_ids"]),
+            )
+
+        index = cls.__new__(cls)
+        index.movie_ids = arrays["movie_ids"]
+
+        people = {
+            name: _Bipartite.from_arrays(
+                {key: arrays[f"{name}_{key}"] for key in _Bipartite.names}
+            )
+            for name in ("actors", "directors")
+        }
+
+        # the matrices wrap the arrays, memory mapped ones are not copied
+        matrices = {
+            name: sparse.csr_matrix(
+                (
+                    arrays[f"{name}_data"],
+                    arrays[f"{name}_indices"],
+                    arrays[f"{name}_indptr"],
+                ),
+                shape=(len(index.movie_ids), len(people[columns].person_ids)),
+            )
+            for name, columns in cls.matrices.items()
+        }
+
+        index._set_parts(people["actors"], people["directors"], **matrices)
+        return index
+
+    @staticmethod
+    def _columns(edges) -> Tuple[np.ndarray, np.ndarray]:
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        return edges[:, 0], edges[:, 1]
+
+    @property
+    def n_movies(self) -> int:
+        return len(self.movie_ids)
+
+    def position(self, movie_id: int) -> Union[int, None]:
+        position = int(positions_of(self.movie_ids, [movie_id])[0])
+        return position if position >= 0 else None
+
+    def actors_of(self, movie: int) -> np.ndarray:
+        return self.actors.people_of(movie)
+
+    def movies_of_actor(self, actor: int) -> np.ndarray:
+        return self.actors.movies_of(actor)
+
+    def director_of(self, movie: int) -> Union[int, None]:
+        """the director with the lowest id, people_of is sorted by id"""
+        directors = self.directors.people_of(movie)
+        return int(directors[0]) if len(directors) else None
+
+    def movies_of_director(self, director: int) -> np.ndarray:
+        return self.directors.movies_of(director)
+
+    def rating_vector(self, movie_ids: List[int], ratings: List[float]) -> np.ndarray:
+        """dense float32 ratings over the movie positions, unknown movies are
+        dropped"""
+        vector = np.zeros(self.n_movies, dtype=np.float32)
+
+        for movie_id, rating in zip(movie_ids, ratings):
+            position = self.position(movie_id)
+            if position is not None:
+                vector[position] += rating
+
+        return vector
+
+    def actor_scores(self, ratings: np.ndarray) -> np.ndarray:
+        """for every movie the sum of the ratings of the other rated movies
+        once per shared actor, (A·Aᵀ)·r without the diagonal"""
+        shared = self.actor_matrix @ (self.actor_matrix.T @ ratings)
+        return shared - self.actor_counts * ratings
+
+    def director_scores(self, ratings: np.ndarray) -> np.ndarray:
+        """for every movie the sum of the ratings of the other rated movies by
+        their first director, like get_credit_scores"""
+        shared = self.director_matrix @ (self.first_director_matrix.T @ ratings)
+        return shared - self.has_director * ratings
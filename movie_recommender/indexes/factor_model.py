@@ -0,0 +1,176 @@
+from movie_recommender import INDEX_PATH
+from movie_recommender.indexes.rating_matrix import RatingMatrix
+from scipy import sparse
+from pathlib import Path
+from loguru import logger
+from typing import Dict, Union
+import numpy as np
+import tqdm
+import json
+import time
+import os
+
+
+def _solve_rows(
+    matrix: sparse.csr_matrix, fixed: np.ndarray, regularization: float
+) -> np.ndarray:
+    """least squares factors for every row of matrix given the fixed factors of
+    the columns, only the observed entries count"""
+    n_factors = fixed.shape[1]
+    eye = regularization * np.eye(n_factors, dtype=np.float64)
+
+    factors = np.zeros((matrix.shape[0], n_factors), dtype=np.float32)
+
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+
+        if start == end:
+            continue
+
+        columns = fixed[matrix.indices[start:end]].astype(np.float64)
+        values = matrix.data[start:end]
+
+        factors[row] = np.linalg.solve(columns.T @ columns + eye, columns.T @ values)
+
+    return factors
+
+
+class FactorModel:
+    """Latent movie factors from alternating least squares on the rating matrix.
+
+    Only the movie factors are kept, they are saved as .npy and opened with
+    mmap so every process shares one copy. A new user is folded in with one
+    small least squares solve over the movies they rated.
+    """
+
+    default_path = INDEX_PATH / "factor_model"
+
+    def __init__(
+        self, movie_ids: np.ndarray, item_factors: np.ndarray, regularization: float
+    ) -> None:
+        self.movie_ids = movie_ids
+        self.item_factors = item_factors
+        self.regularization = float(regularization)
+
+        self.movie_index = {int(movie_id): i for i, movie_id in enumerate(movie_ids)}
+
+    @property
+    def n_factors(self) -> int:
+        return self.item_factors.shape[1]
+
+    @classmethod
+    def train(
+        cls,
+        matrix: RatingMatrix,
+        n_factors=32,
+        regularization=0.1,
+        iterations=10,
+        seed=0,
+    ) -> "FactorModel":
+        start = time.time()
+        rng = np.random.default_rng(seed)
+
+        by_user = matrix.values.tocsr()
+        by_movie = matrix.values.T.tocsr()
+
+        item_factors = rng.normal(scale=0.1, size=(by_user.shape[1], n_factors)).astype(
+            np.float32
+        )
+
+        for _ in tqdm.tqdm(range(iterations), "Training factors"):
+            user_factors = _solve_rows(by_user, item_factors, regularization)
+            item_factors = _solve_rows(by_movie, user_factors, regularization)
+
+        rows = np.repeat(np.arange(by_user.shape[0]), np.diff(by_user.indptr))
+        error = by_user.data - np.einsum(
+            "ij,ij->i", user_factors[rows], item_factors[by_user.indices]
+        )
+        logger.info(
+            f"Trained {n_factors} factors in {time.time() - start:.2f}s, rmse {np.sqrt(np.mean(error**2)):.4f}"
+        )
+
+        return cls(matrix.movie_ids.copy(), item_factors, regularization)
+
+    def fold_in(self, movie_ids, ratings) -> np.ndarray:
+        """factors of a user that is not part of the model"""
+        rows = [self.movie_index.get(int(i)) for i in movie_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+
+        if not known:
+            return np.zeros(self.n_factors, dtype=np.float32)
+
+        columns = np.asarray(
+            self.item_factors[[rows[i] for i in known]], dtype=np.float64
+        )
+        values = np.array([ratings[i] for i in known], dtype=np.float64)
+
+        eye = self.regularization * np.eye(self.n_factors)
+        user = np.linalg.solve(columns.T @ columns + eye, columns.T @ values)
+
+        return user.astype(np.float32)
+
+    def score(self, movie_ids, ratings) -> np.ndarray:
+        """predicted rating of every movie as a dense vector over movie_ids"""
+        return self.item_factors @ self.fold_in(movie_ids, ratings)
+
+    def score_many(self, ratings: sparse.csr_matrix) -> np.ndarray:
+        """score for every row of a users x movie_ids rating matrix, folds all
+        users in at once"""
+        user_factors = _solve_rows(ratings, self.item_factors, self.regularization)
+        return user_factors @ np.asarray(self.item_factors).T
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "movie_ids": self.movie_ids,
+            "item_factors": self.item_factors,
+            "regularization": np.array(self.regularization),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "FactorModel":
+        return cls(
+            arrays["movie_ids"],
+            arrays["item_factors"],
+            float(arrays["regularization"]),
+        )
+
+    def save(self, path: Union[Path, str] = None) -> Path:
+        path = Path(path or self.default_path)
+        os.makedirs(path, exist_ok=True)
+
+        np.save(path / "movie_ids.npy", self.movie_ids)
+        np.save(path / "item_factors.npy", self.item_factors)
+
+        with open(path / "model.json", "w") as f:
+            json.dump(
+                {"n_factors": self.n_factors, "regularization": self.regularization},
+                f,
+            )
+
+        logger.success(f"Saved factor model to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Union[Path, str] = None) -> "FactorModel":
+        path = Path(path or cls.default_path)
+
+        with open(path / "model.json") as f:
+            meta = json.load(f)
+
+        return cls(
+            np.load(path / "movie_ids.npy"),
+            np.load(path / "item_factors.npy", mmap_mode="r"),
+            meta["regularization"],
+        )
+
+    @classmethod
+    def load_if_exists(
+        cls, path: Union[Path, str] = None
+    ) -> Union["FactorModel", None]:
+        path = Path(path or cls.default_path)
+
+        if not (path / "model.json").exists():
+            logger.info(f"No factor model at {path}, run 'flask trainfactors'")
+            return None
+
+        return cls.load(path)
@@ -0,0 +1,143 @@
+from movie_recommender import INDEX_PATH
+from movie_recommender.indexes.rating_matrix import RatingMatrix
+from scipy import sparse
+from pathlib import Path
+from loguru import logger
+from typing import Dict, Union
+import numpy as np
+import tqdm
+import time
+import os
+
+
+class ItemSimilarityTable:
+    """Top k item-item cosine similarities between the rating matrix columns.
+
+    Row i holds the k most similar movies of movie_ids[i] as int32 movie ids
+    (-1 pads rows with fewer positive neighbours) and float32 similarities.
+    """
+
+    default_path = INDEX_PATH / "item_similarity.npz"
+
+    def __init__(
+        self, movie_ids: np.ndarray, neighbour_ids: np.ndarray, scores: np.ndarray
+    ) -> None:
+        self.movie_ids = movie_ids
+        self.neighbour_ids = neighbour_ids
+        self.scores = scores
+
+        self.movie_index = {int(movie_id): i for i, movie_id in enumerate(movie_ids)}
+
+        # positions of the neighbours in movie_ids, padding points at row 0
+        # with a score of 0 so it never adds anything
+        self.neighbours = np.searchsorted(movie_ids, np.maximum(neighbour_ids, 0))
+        self.neighbours = self.neighbours.astype(np.int32)
+
+    @property
+    def k(self) -> int:
+        return self.neighbour_ids.shape[1]
+
+    @classmethod
+    def build(cls, matrix: RatingMatrix, k=50, chunksize=512) -> "ItemSimilarityTable":
+        start = time.time()
+
+        values = matrix.values.tocsc().astype(np.float32)
+        n_movies = values.shape[1]
+
+        norms = np.sqrt(np.asarray(values.multiply(values).sum(axis=0)).ravel())
+        inverse_norms = np.divide(
+            1, norms, out=np.zeros_like(norms), where=norms > 0
+        ).astype(np.float32)
+
+        k = min(k, max(n_movies - 1, 1))
+        neighbour_ids = np.full((n_movies, k), -1, dtype=np.int32)
+        scores = np.zeros((n_movies, k), dtype=np.float32)
+
+        for chunk_start in tqdm.tqdm(
+            range(0, n_movies, chunksize), "Computing item similarities"
+        ):
+            chunk = np.arange(chunk_start, min(chunk_start + chunksize, n_movies))
+
+            similarity = (values[:, chunk].T @ values).toarray()
+            similarity *= inverse_norms[chunk, None] * inverse_norms[None, :]
+            similarity[np.arange(len(chunk)), chunk] = 0
+
+            best = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(similarity, best, axis=1)
+
+            order = np.argsort(-best_scores, axis=1)
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+            positive = best_scores > 0
+            neighbour_ids[chunk] = np.where(positive, matrix.movie_ids[best], -1)
+            scores[chunk] = np.where(positive, best_scores, 0)
+
+        logger.info(
+            f"Built item similarities for {n_movies} movies in {time.time() - start:.2f}s"
+        )
+        return cls(matrix.movie_ids.copy(), neighbour_ids, scores)
+
+    def score(self, movie_ids, ratings) -> np.ndarray:
+        """sum of the similarity rows of the rated movies weighted by rating,
+        as a dense vector over movie_ids"""
+        rows = [self.movie_index.get(int(i)) for i in movie_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+
+        rows = np.array([rows[i] for i in known], dtype=np.int32)
+        weights = np.array([ratings[i] for i in known], dtype=np.float32)
+
+        totals = np.zeros(len(self.movie_ids), dtype=np.float32)
+        np.add.at(
+            totals,
+            self.neighbours[rows].ravel(),
+            (self.scores[rows] * weights[:, None]).ravel(),
+        )
+        return totals
+
+    def matrix(self) -> sparse.csr_matrix:
+        """movie_ids x movie_ids similarities, ratings @ matrix() is score for
+        every row of a users x movie_ids rating matrix"""
+        rows = np.repeat(np.arange(len(self.movie_ids)), self.k)
+        return sparse.csr_matrix(
+            (self.scores.ravel(), (rows, self.neighbours.ravel())),
+            shape=(len(self.movie_ids), len(self.movie_ids)),
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "movie_ids": self.movie_ids,
+            "neighbour_ids": self.neighbour_ids,
+            "scores": self.scores,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "ItemSimilarityTable":
+        return cls(arrays["movie_ids"], arrays["neighbour_ids"], arrays["scores"])
+
+    def save(self, path: Union[Path, str] = None) -> Path:
+        path = Path(path or self.default_path)
+        os.makedirs(path.parent, exist_ok=True)
+
+        np.savez(path, **self.arrays())
+        logger.success(f"Saved item similarities to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Union[Path, str] = None) -> "ItemSimilarityTable":
+        with np.load(Path(path or cls.default_path)) as data:
+            return cls.from_arrays(data)
+
+    @classmethod
+    def load_if_exists(
+        cls, path: Union[Path, str] = None
+    ) -> Union["ItemSimilarityTable", None]:
+        path = Path(path or cls.default_path)
+
+        if not path.exists():
+            logger.info(
+                f"No item similarities at {path}, run 'flask builditemsimilarity'"
+            )
+            return None
+
+        return cls.load(path)
@@ -0,0 +1,222 @@
+from movie_recommender.querying.sql_models import Movie, MovieGenre, Tag
+from movie_recommender.querying.querying_and_validation import get_unique_genres
+from movie_recommender.indexes.rating_matrix import load_movie_ids
+from movie_recommender.indexes.versioning import CatalogIndex
+from scipy import sparse
+from loguru import logger
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import time
+
+
+class MovieCatalog(CatalogIndex):
+    """Read-only arrays of every movie, loaded once instead of hydrating Movie
+    objects in every job.
+
+    Position i belongs to movie_ids[i], the same axis as the rating matrix and
+    the credit index. Genres are a bitmask over `genres` and tags are CSR
+    offsets into the `tags` vocabulary.
+    """
+
+    def __init__(
+        self,
+        movie_ids: np.ndarray,
+        titles: List[str],
+        years: np.ndarray,
+        imdb_ids: List[str],
+        imdb_links: List[str],
+        genres: Tuple[str, ...],
+        genre_masks: np.ndarray,
+        tags: Tuple[str, ...],
+        tag_offsets: np.ndarray,
+        tag_ids: np.ndarray,
+    ) -> None:
+        assert len(genres) <= 64, "genre masks only have 64 bits"
+
+        self.movie_ids = movie_ids
+        self.titles = titles
+        # 0 where the year is unknown
+        self.years = years
+        self.imdb_ids = imdb_ids
+        self.imdb_links = imdb_links
+
+        self.genres = genres
+        self.genre_masks = genre_masks
+
+        self.tags = tags
+        self.tag_offsets = tag_offsets
+        self.tag_ids = tag_ids
+
+        self.movie_index: Dict[int, int] = {
+            int(movie_id): i for i, movie_id in enumerate(movie_ids)
+        }
+
+    @classmethod
+    def from_db(cls, db) -> "MovieCatalog":
+        start = time.time()
+
+        movie_ids = load_movie_ids(db)
+        n_movies = len(movie_ids)
+        movie_index = {int(movie_id): i for i, movie_id in enumerate(movie_ids)}
+
+        titles, imdb_ids, imdb_links = [""] * n_movies, [""] * n_movies, [""] * n_movies
+        years = np.zeros(n_movies, dtype=np.int32)
+
+        # only the columns, no Movie objects and their joined ratings
+        for movie_id, title, year, imdb_id, imdb_link in db.session.query(
+            Movie.id, Movie.title, Movie.year, Movie.imdb_id, Movie.imdbId_link
+        ):
+            i = movie_index[movie_id]
+            titles[i], imdb_ids[i], imdb_links[i] = title, imdb_id, imdb_link
+            years[i] = year or 0
+
+        # the same vocabulary the genre filter of the recommendations page uses
+        genres = tuple(sorted(get_unique_genres(db).values()))
+        genre_bits = {
+            genre: np.uint64(1) << np.uint64(i) for i, genre in enumerate(genres)
+        }
+        genre_masks = np.zeros(n_movies, dtype=np.uint64)
+
+        for movie_id, genre in db.session.query(MovieGenre.movie_id, MovieGenre.genre):
+            if movie_id in movie_index and genre in genre_bits:
+                genre_masks[movie_index[movie_id]] |= genre_bits[genre]
+
+        tag_rows = [
+            (movie_index[movie_id], tag)
+            for movie_id, tag in db.session.query(Tag.movie_id, Tag.tag).order_by(
+                Tag.id
+            )
+            if movie_id in movie_index
+        ]
+        tags = tuple(sorted({tag for _, tag in tag_rows}))
+        tag_index = {tag: i for i, tag in enumerate(tags)}
+
+        # stable, so the tags of a movie keep the order of their ids
+        tag_movies = np.array([row[0] for row in tag_rows], dtype=np.int32)
+        order = np.argsort(tag_movies, kind="stable")
+        tag_ids = np.array([tag_index[row[1]] for row in tag_rows], dtype=np.int32)
+        tag_ids = tag_ids[order]
+
+        tag_offsets = np.zeros(n_movies + 1, dtype=np.int32)
+        np.cumsum(np.bincount(tag_movies, minlength=n_movies), out=tag_offsets[1:])
+
+        catalog = cls(
+            movie_ids,
+            titles,
+            years,
+            imdb_ids,
+            imdb_links,
+            genres,
+            genre_masks,
+            tags,
+            tag_offsets,
+            tag_ids,
+        )
+
+        logger.info(
+            f"Built movie catalog with {n_movies} movies and {len(tag_rows)} tags in {time.time() - start:.2f}s"
+        )
+        return catalog
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """the strings become fixed width unicode arrays, missing imdb ids and
+        links become empty strings"""
+        return {
+            "movie_ids": self.movie_ids,
+            "titles": np.array(self.titles, dtype=str),
+            "years": self.years,
+            "imdb_ids": np.array([i or "" for i in self.imdb_ids], dtype=str),
+            "imdb_links": np.array([i or "" for i in self.imdb_links], dtype=str),
+            "genres": np.array(self.genres, dtype=str),
+            "genre_masks": self.genre_masks,
+            "tags": np.array(self.tags, dtype=str),
+            "tag_offsets": self.tag_offsets,
+            "tag_ids": self.tag_ids,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "MovieCatalog":
+        return cls(
+            arrays["movie_ids"],
+            arrays["titles"].tolist(),
+            arrays["years"],
+            arrays["imdb_ids"].tolist(),
+            arrays["imdb_links"].tolist(),
+            tuple(arrays["genres"].tolist()),
+            arrays["genre_masks"],
+            tuple(arrays["tags"].tolist()),
+            arrays["tag_offsets"],
+            arrays["tag_ids"],
+        )
+
+    def __len__(self) -> int:
+        return len(self.movie_ids)
+
+    def matches(self, movie_ids: np.ndarray) -> bool:
+        """if an index uses the same movie axis as the catalog"""
+        return len(movie_ids) == len(self.movie_ids) and np.array_equal(
+            movie_ids, self.movie_ids
+        )
+
+    def positions(self, movie_ids: Iterable[int]) -> np.ndarray:
+        """int32 positions of the movie ids, -1 for unknown movies"""
+        return np.array(
+            [self.movie_index.get(int(movie_id), -1) for movie_id in movie_ids],
+            dtype=np.int32,
+        )
+
+    def rated(
+        self, movie_ids: Iterable[int], values: Iterable[float]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """positions and ratings of a users ratings, unknown movies are dropped"""
+        positions = self.positions(movie_ids)
+        values = np.asarray(list(values), dtype=np.float32)
+
+        known = positions >= 0
+        return positions[known], values[known]
+
+    def scatter(self, movie_ids: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """moves dense vectors over another movie axis (the last one) onto the
+        catalog, movies the catalog does not know are dropped"""
+        if self.matches(movie_ids):
+            return np.asarray(values, dtype=np.float32)
+
+        positions = self.positions(movie_ids)
+        known = positions >= 0
+
+        dense = np.zeros(values.shape[:-1] + (len(self),), dtype=np.float32)
+        dense[..., positions[known]] = values[..., known]
+        return dense
+
+    def projection(self, movie_ids: np.ndarray) -> sparse.csr_matrix:
+        """catalog x movie_ids 0/1 matrix, ratings @ projection moves a users x
+        catalog matrix onto the other movie axis"""
+        positions = self.positions(movie_ids)
+        known = np.flatnonzero(positions >= 0)
+
+        return sparse.csr_matrix(
+            (np.ones(len(known), dtype=np.float32), (positions[known], known)),
+            shape=(len(self), len(movie_ids)),
+        )
+
+    def genre_mask(self, genres: Iterable[str]) -> np.uint64:
+        mask = np.uint64(0)
+        for genre in genres:
+            mask |= np.uint64(1) << np.uint64(self.genres.index(genre))
+        return mask
+
+    def with_genres(self, mask: np.uint64) -> np.ndarray:
+        """bool over the positions, which movies have every genre of the mask"""
+        return (self.genre_masks & mask) == mask
+
+    def genres_of(self, position: int) -> List[str]:
+        mask = int(self.genre_masks[position])
+        return [genre for i, genre in enumerate(self.genres) if mask >> i & 1]
+
+    def tags_of(self, position: int) -> List[str]:
+        return [
+            self.tags[i]
+            for i in self.tag_ids[
+                self.tag_offsets[position] : self.tag_offsets[position + 1]
+            ]
+        ]
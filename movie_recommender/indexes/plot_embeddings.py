@@ -0,0 +1,192 @@
+from movie_recommender import INDEX_PATH
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Union
+import numpy as np
+import shutil
+import tqdm
+import time
+import os
+
+
+class PlotEmbeddingMatrix:
+    """All plot embeddings of the chroma collection as one L2 normalized float32
+    matrix, opened with mmap so the OS page cache shares it between the web
+    and the background processes. Row i belongs to movie_ids[i].
+
+    As the collection uses cosine space, the dot product of two rows is the
+    same similarity chroma returns (1 - cosine distance).
+
+    Every export is its own version directory and the CURRENT file names the
+    one to load, so the embeddings and their movie ids are swapped together.
+    """
+
+    default_path = INDEX_PATH / "plot_embeddings"
+
+    def __init__(
+        self,
+        movie_ids: np.ndarray,
+        embeddings: np.ndarray,
+        path: Path = None,
+        version: str = None,
+    ) -> None:
+        self.movie_ids = movie_ids
+        self.embeddings = embeddings
+
+        self.path = path
+        self.version = version
+
+        self.movie_index: Dict[int, int] = {
+            int(movie_id): i for i, movie_id in enumerate(movie_ids)
+        }
+
+    def __len__(self) -> int:
+        return len(self.movie_ids)
+
+    @classmethod
+    def export(
+        cls, collection, path: Union[Path, str] = None, batchsize=1000
+    ) -> "PlotEmbeddingMatrix":
+        """writes every embedding of the chroma collection to path"""
+        path = Path(path or cls.default_path)
+        os.makedirs(path, exist_ok=True)
+
+        count = collection.count()
+        ids, chunks = [], []
+
+        for offset in tqdm.tqdm(
+            range(0, count, batchsize), "Exporting plot embeddings"
+        ):
+            batch = collection.get(
+                include=["embeddings"], limit=batchsize, offset=offset
+            )
+            ids.extend(int(i) for i in batch["ids"])
+            chunks.append(np.asarray(batch["embeddings"], dtype=np.float32))
+
+        movie_ids = np.array(ids, dtype=np.int32)
+        embeddings = np.concatenate(chunks) if chunks else np.zeros((0, 0), np.float32)
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = np.divide(
+            embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0
+        )
+
+        order = np.argsort(movie_ids)
+
+        # both files are written to a new directory and CURRENT is pointed at
+        # it afterwards, readers never see one file without the other
+        version = str(time.time_ns())
+        tmp = path / f".{version}.tmp"
+        os.makedirs(tmp)
+
+        np.save(tmp / "embeddings.npy", embeddings[order])
+        np.save(tmp / "movie_ids.npy", movie_ids[order])
+        os.replace(tmp, path / version)
+
+        with open(path / "CURRENT.tmp", "w") as f:
+            f.write(version)
+        os.replace(path / "CURRENT.tmp", path / "CURRENT")
+
+        cls._remove_old_versions(path, version)
+
+        logger.success(f"Exported {len(movie_ids)} plot embeddings to {path}")
+        return cls.load(path)
+
+    @staticmethod
+    def _remove_old_versions(path: Path, version: str, keep=2) -> None:
+        # the previous version stays for the processes that still map it
+        versions = sorted(
+            (p for p in path.iterdir() if p.is_dir() and p.name.isdigit()),
+            key=lambda p: int(p.name),
+        )
+        for old in versions[:-keep]:
+            if old.name != version:
+                shutil.rmtree(old, ignore_errors=True)
+
+        # files of the exports before the version directories
+        for name in ("embeddings.npy", "movie_ids.npy"):
+            if (path / name).exists():
+                os.remove(path / name)
+
+    @staticmethod
+    def current_version(path: Union[Path, str] = None) -> Union[str, None]:
+        try:
+            with open(Path(path or PlotEmbeddingMatrix.default_path) / "CURRENT") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def load(cls, path: Union[Path, str] = None) -> "PlotEmbeddingMatrix":
+        path = Path(path or cls.default_path)
+        version = cls.current_version(path)
+        # exports before the version directories wrote the files to path
+        files = path / version if version is not None else path
+
+        return cls(
+            np.load(files / "movie_ids.npy"),
+            np.load(files / "embeddings.npy", mmap_mode="r"),
+            path,
+            version,
+        )
+
+    def changed_on_disk(self) -> bool:
+        return self.path is not None and self.current_version(self.path) != self.version
+
+    @classmethod
+    def exists(cls, path: Union[Path, str] = None) -> bool:
+        path = Path(path or cls.default_path)
+        version = cls.current_version(path)
+        files = path / version if version is not None else path
+        return (files / "embeddings.npy").exists() and (
+            files / "movie_ids.npy"
+        ).exists()
+
+    def similarities(self, movie_ids: List[int]) -> np.ndarray:
+        """(len(movie_ids) x len(self)) similarities, movie_ids must be known"""
+        rows = [self.movie_index[int(i)] for i in movie_ids]
+        return np.asarray(self.embeddings[rows]) @ self.embeddings.T
+
+    def top_k(self, similarities: np.ndarray, exclude: np.ndarray, top_k: int):
+        """positions and scores of the top_k of every row, excluding the given
+        column of every row (the movie itself)"""
+        similarities[np.arange(len(similarities)), exclude] = -np.inf
+
+        top_k = min(top_k, similarities.shape[1] - 1)
+        if top_k <= 0:
+            empty = np.zeros((len(similarities), 0))
+            return empty.astype(np.int32), empty.astype(np.float32)
+
+        best = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(similarities, best, axis=1)
+
+        order = np.argsort(-scores, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+
+        return best.astype(np.int32), scores.astype(np.float32)
+
+    def query_many(self, movie_ids: List[int], top_k) -> List[Dict[int, float]]:
+        """same as CHROMA_Manager.query_many, movies without an embedding get
+        an empty map"""
+        results: List[Dict[int, float]] = [{} for _ in movie_ids]
+        known = [i for i, movie_id in enumerate(movie_ids) if movie_id in self]
+
+        if not known:
+            return results
+
+        queried = [movie_ids[i] for i in known]
+        rows = np.array([self.movie_index[int(i)] for i in queried])
+
+        best, scores = self.top_k(self.similarities(queried), rows, top_k)
+
+        for i, positions, similarities in zip(known, best, scores):
+            results[i] = {
+                int(self.movie_ids[position]): float(similarity)
+                for position, similarity in zip(positions, similarities)
+            }
+
+        return results
+
+    def __contains__(self, movie_id: int) -> bool:
+        return int(movie_id) in self.movie_index
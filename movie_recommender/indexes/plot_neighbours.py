@@ -0,0 +1,206 @@
+from movie_recommender import INDEX_PATH
+from movie_recommender.indexes.plot_embeddings import PlotEmbeddingMatrix
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Union
+import numpy as np
+import time
+import os
+
+
+def _top_k(candidates: np.ndarray, scores: np.ndarray, k: int):
+    """the k best candidates of every row, sorted by score"""
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+
+    return (
+        np.take_along_axis(candidates, best, axis=1),
+        np.take_along_axis(best_scores, order, axis=1),
+    )
+
+
+class PlotNeighbourTable:
+    """The top k plot neighbours of every movie, computed offline from the
+    plot embedding matrix. Row i holds the int32 ids and float32 similarities
+    of the neighbours of movie_ids[i]."""
+
+    default_path = INDEX_PATH / "plot_neighbours.npz"
+
+    def __init__(
+        self, movie_ids: np.ndarray, neighbour_ids: np.ndarray, scores: np.ndarray
+    ) -> None:
+        self.movie_ids = movie_ids
+        self.neighbour_ids = neighbour_ids
+        self.scores = scores
+
+        self.movie_index: Dict[int, int] = {
+            int(movie_id): i for i, movie_id in enumerate(movie_ids)
+        }
+
+    @property
+    def k(self) -> int:
+        return self.neighbour_ids.shape[1]
+
+    def __contains__(self, movie_id: int) -> bool:
+        return int(movie_id) in self.movie_index
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: PlotEmbeddingMatrix,
+        k=20,
+        previous: "PlotNeighbourTable" = None,
+        chunksize=256,
+        workers=None,
+    ) -> "PlotNeighbourTable":
+        """with a previous table only the movies added since are computed and
+        merged into the old rows"""
+        start = time.time()
+        workers = workers or os.cpu_count()
+
+        if previous is not None and (
+            previous.k != k
+            or not np.isin(previous.movie_ids, embeddings.movie_ids).all()
+        ):
+            logger.info("Previous plot neighbours do not fit, building all")
+            previous = None
+
+        if previous is None:
+            new_ids = embeddings.movie_ids
+        else:
+            new_ids = np.setdiff1d(embeddings.movie_ids, previous.movie_ids)
+
+            if len(new_ids) == 0:
+                logger.info("Plot neighbours are up to date")
+                return previous
+
+        def new_rows(chunk: np.ndarray):
+            similarities = embeddings.similarities(chunk)
+            exclude = np.searchsorted(embeddings.movie_ids, chunk)
+            best, scores = embeddings.top_k(similarities, exclude, k)
+            return embeddings.movie_ids[best], scores
+
+        chunks = [new_ids[i : i + chunksize] for i in range(0, len(new_ids), chunksize)]
+
+        with ThreadPoolExecutor(workers) as executor:
+            computed = list(executor.map(new_rows, chunks))
+
+        movie_ids = [new_ids]
+        neighbour_ids = [np.concatenate([ids for ids, _ in computed])]
+        scores = [np.concatenate([s for _, s in computed])]
+
+        if previous is not None:
+            new_rows_pos = np.searchsorted(embeddings.movie_ids, new_ids)
+            new_vectors = np.asarray(embeddings.embeddings[new_rows_pos])
+
+            def merge(rows: np.ndarray):
+                old_ids = previous.movie_ids[rows]
+                old_vectors = np.asarray(
+                    embeddings.embeddings[
+                        np.searchsorted(embeddings.movie_ids, old_ids)
+                    ]
+                )
+                candidates = np.hstack(
+                    [
+                        previous.neighbour_ids[rows],
+                        np.broadcast_to(new_ids, (len(rows), len(new_ids))),
+                    ]
+                )
+                candidate_scores = np.hstack(
+                    [previous.scores[rows], old_vectors @ new_vectors.T]
+                )
+                return _top_k(candidates, candidate_scores, k)
+
+            old_chunks = [
+                np.arange(i, min(i + chunksize, len(previous.movie_ids)))
+                for i in range(0, len(previous.movie_ids), chunksize)
+            ]
+
+            with ThreadPoolExecutor(workers) as executor:
+                merged = list(executor.map(merge, old_chunks))
+
+            movie_ids.append(previous.movie_ids)
+            neighbour_ids.append(np.concatenate([ids for ids, _ in merged]))
+            scores.append(np.concatenate([s for _, s in merged]))
+
+        movie_ids = np.concatenate(movie_ids)
+        order = np.argsort(movie_ids)
+
+        table = cls(
+            movie_ids[order].astype(np.int32),
+            np.concatenate(neighbour_ids)[order].astype(np.int32),
+            np.concatenate(scores)[order].astype(np.float32),
+        )
+
+        logger.info(
+            f"Computed plot neighbours of {len(new_ids)} movies in {time.time() - start:.2f}s"
+        )
+        return table
+
+    def query_many(
+        self, movie_ids: List[int], top_k
+    ) -> List[Union[Dict[int, float], None]]:
+        """id -> similarity maps like CHROMA_Manager.query_many, None for the
+        movies the table does not cover"""
+        results = []
+
+        for movie_id in movie_ids:
+            row = self.movie_index.get(int(movie_id))
+
+            if row is None:
+                results.append(None)
+                continue
+
+            results.append(
+                {
+                    int(other): float(score)
+                    for other, score in zip(
+                        self.neighbour_ids[row, :top_k], self.scores[row, :top_k]
+                    )
+                }
+            )
+
+        return results
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "movie_ids": self.movie_ids,
+            "neighbour_ids": self.neighbour_ids,
+            "scores": self.scores,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "PlotNeighbourTable":
+        return cls(arrays["movie_ids"], arrays["neighbour_ids"], arrays["scores"])
+
+    def save(self, path: Union[Path, str] = None) -> Path:
+        path = Path(path or self.default_path)
+        os.makedirs(path.parent, exist_ok=True)
+
+        np.savez(path, **self.arrays())
+        logger.success(f"Saved plot neighbours to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Union[Path, str] = None) -> "PlotNeighbourTable":
+        with np.load(Path(path or cls.default_path)) as data:
+            return cls.from_arrays(data)
+
+    @classmethod
+    def load_if_exists(
+        cls, path: Union[Path, str] = None
+    ) -> Union["PlotNeighbourTable", None]:
+        path = Path(path or cls.default_path)
+
+        if not path.exists():
+            logger.info(
+                f"No plot neighbours at {path}, run 'flask buildplotneighbours'"
+            )
+            return None
+
+        return cls.load(path)
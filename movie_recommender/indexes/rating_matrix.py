@@ -0,0 +1,169 @@
+from movie_recommender.querying.sql_models import Movie, Rating
+from movie_recommender.utils import normalize_score
+from movie_recommender.indexes.versioning import CatalogIndex
+from scipy import sparse
+from loguru import logger
+from typing import Dict, List, Tuple
+import numpy as np
+import time
+
+
+def load_movie_ids(db) -> np.ndarray:
+    """sorted ids of all movies, the column order of every in-memory index"""
+    ids = [row[0] for row in db.session.query(Movie.id).order_by(Movie.id).all()]
+    return np.array(ids, dtype=np.int32)
+
+
+def positions_of(sorted_ids: np.ndarray, ids) -> np.ndarray:
+    """positions of ids in sorted_ids, -1 for the unknown ones. A binary
+    search instead of an id dict, so memory mapped indexes stay on disk."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int32)
+
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == ids, positions, -1).astype(np.int32)
+
+
+class RatingMatrix(CatalogIndex):
+    """CSR matrix of old users x movies holding normalized ratings.
+
+    Ratings of 2.5 normalize to 0, so which entries exist is kept in a second
+    matrix `rated` with the same structure.
+    """
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        movie_ids: np.ndarray,
+        values: sparse.csr_matrix,
+        rated: sparse.csr_matrix,
+        rated_csc: sparse.csc_matrix = None,
+    ) -> None:
+        """movie_ids are sorted, rated_csc is computed when not passed"""
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.values = values
+        self.rated = rated
+
+        # column slicing is cheap on csc
+        self.rated_csc = rated_csc if rated_csc is not None else rated.tocsc()
+
+    @classmethod
+    def from_db(cls, db) -> "RatingMatrix":
+        start = time.time()
+
+        movie_ids = load_movie_ids(db)
+
+        rows = (
+            db.session.query(Rating.old_user_id, Rating.movie_id, Rating.value)
+            .filter(Rating.old_user_id.isnot(None))
+            .all()
+        )
+
+        matrix = cls.from_triples(rows, movie_ids)
+
+        logger.info(
+            f"Built rating matrix {matrix.shape} with {matrix.values.nnz} ratings in {time.time() - start:.2f}s"
+        )
+        return matrix
+
+    @classmethod
+    def from_triples(
+        cls, rows: List[Tuple[int, int, float]], movie_ids: np.ndarray
+    ) -> "RatingMatrix":
+        """rows are (old_user_id, movie_id, raw rating)"""
+        movie_index = {int(movie_id): i for i, movie_id in enumerate(movie_ids)}
+
+        # ratings of movies we do not know are skipped, like rating.movie is None
+        rows = [row for row in rows if row[1] in movie_index]
+
+        user_ids = np.array(sorted({row[0] for row in rows}), dtype=np.int32)
+        user_index = {int(user_id): i for i, user_id in enumerate(user_ids)}
+
+        row_idx = np.array([user_index[row[0]] for row in rows], dtype=np.int32)
+        col_idx = np.array([movie_index[row[1]] for row in rows], dtype=np.int32)
+        data = normalize_score(np.array([row[2] for row in rows], dtype=np.float32))
+
+        shape = (len(user_ids), len(movie_ids))
+
+        values = sparse.csr_matrix((data, (row_idx, col_idx)), shape=shape)
+        rated = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (row_idx, col_idx)), shape=shape
+        )
+
+        return cls(user_ids, movie_ids, values, rated)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"user_ids": self.user_ids, "movie_ids": self.movie_ids}
+
+        for name, matrix in (
+            ("values", self.values),
+            ("rated", self.rated),
+            ("rated_csc", self.rated_csc),
+        ):
+            arrays[f"{name}_data"] = matrix.data
+            arrays[f"{name}_indices"] = matrix.indices
+            arrays[f"{name}_indptr"] = matrix.indptr
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "RatingMatrix":
+        shape = (len(arrays["user_ids"]), len(arrays["movie_ids"]))
+
+        # the matrices wrap the arrays, memory mapped ones are not copied
+        values, rated = (
+            sparse.csr_matrix(
+                (
+                    arrays[f"{name}_data"],
+                    arrays[f"{name}_indices"],
+                    arrays[f"{name}_indptr"],
+                ),
+                shape=shape,
+            )
+            for name in ("values", "rated")
+        )
+
+        rated_csc = None
+        # older files only hold the csr matrices
+        if "rated_csc_indptr" in arrays:
+            rated_csc = sparse.csc_matrix(
+                (
+                    arrays["rated_csc_data"],
+                    arrays["rated_csc_indices"],
+                    arrays["rated_csc_indptr"],
+                ),
+                shape=shape,
+            )
+
+        return cls(arrays["user_ids"], arrays["movie_ids"], values, rated, rated_csc)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    def columns(self, movie_ids: List[int]) -> np.ndarray:
+        """column positions of the movie ids, unknown movies are dropped"""
+        columns = positions_of(self.movie_ids, movie_ids)
+        return columns[columns >= 0]
+
+    def overlapping_users(self, columns: np.ndarray) -> np.ndarray:
+        """rows of all old users that rated at least one of the columns"""
+        return np.unique(self.rated_csc[:, columns].indices).astype(np.int32)
+
+    def neighbour_vectors(
+        self, rows: np.ndarray, columns: np.ndarray, default_vec_val: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """dense (rows x columns) block of normalized ratings, padded with the
+        normalized default where a user did not rate the movie, and the mask of
+        the entries that were really rated"""
+        block = self.values[rows][:, columns].toarray()
+        mask = self.rated[rows][:, columns].toarray() > 0
+
+        block[~mask] = normalize_score(default_vec_val)
+        return block, mask
+
+    def summed_ratings(self, rows: np.ndarray) -> np.ndarray:
+        """sum of the normalized ratings of the rows for every movie"""
+        return np.asarray(self.values[rows].sum(axis=0)).ravel()
@@ -0,0 +1,194 @@
+from movie_recommender import INDEX_PATH
+from movie_recommender.indexes.versioning import catalog_version
+from movie_recommender.indexes.rating_matrix import RatingMatrix
+from movie_recommender.indexes.credit_index import CreditIndex
+from movie_recommender.indexes.movie_catalog import MovieCatalog
+from movie_recommender.indexes.user_ann_index import UserANNIndex
+from movie_recommender.indexes.item_similarity import ItemSimilarityTable
+from movie_recommender.indexes.factor_model import FactorModel
+from movie_recommender.indexes.plot_neighbours import PlotNeighbourTable
+from pathlib import Path
+from loguru import logger
+from typing import Dict, Union
+import numpy as np
+import threading
+import shutil
+import json
+import time
+import os
+
+SNAPSHOT_PATH = INDEX_PATH / "snapshots"
+
+
+class ModelSnapshot:
+    """Everything a recommendation job reads, as one versioned directory.
+
+    Every array is its own .npy file next to a manifest.json, loading memory
+    maps them, so it takes milliseconds and forked workers share the pages.
+    `flask buildsnapshot` writes a new version and then points the CURRENT
+    file at it, get_current swaps to it with the next job.
+    """
+
+    # name -> index class with arrays / from_arrays, the optional ones are None
+    # when their model was not built
+    components = {
+        "catalog": MovieCatalog,
+        "rating_matrix": RatingMatrix,
+        "credit_index": CreditIndex,
+        "ann_index": UserANNIndex,
+        "item_similarity": ItemSimilarityTable,
+        "factor_model": FactorModel,
+        "plot_neighbours": PlotNeighbourTable,
+    }
+
+    _current: "ModelSnapshot" = None
+    _lock = threading.Lock()
+
+    def __init__(
+        self, version: str, catalog_version: str, weights: dict, **parts
+    ) -> None:
+        self.version = version
+        # the snapshot is stale once 'flask initdb' bumped the catalog version
+        self.catalog_version = catalog_version
+        self.weights = weights
+
+        for name in self.components:
+            setattr(self, name, parts.get(name))
+
+        # jobs compare these with the catalog version like get_instance does
+        for index in (self.catalog, self.rating_matrix, self.credit_index):
+            index.catalog_version = catalog_version
+
+    @classmethod
+    def build(cls, db, weights: dict, **models) -> "ModelSnapshot":
+        """catalog, rating matrix and credits freshly from the db, the other
+        models as passed, usually their load_if_exists"""
+        return cls(
+            str(time.time_ns()),
+            catalog_version(),
+            weights,
+            catalog=MovieCatalog.from_db(db),
+            rating_matrix=RatingMatrix.from_db(db),
+            credit_index=CreditIndex.from_db(db),
+            **models,
+        )
+
+    def save(self, root: Union[Path, str] = None) -> Path:
+        root = Path(root or SNAPSHOT_PATH)
+        path = root / self.version
+        # written next to it and renamed, a half written snapshot is never seen
+        tmp = root / f".{self.version}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+
+        manifest = {
+            "version": self.version,
+            "catalog_version": self.catalog_version,
+            "created": time.time(),
+            "weights": self.weights,
+            "components": {},
+        }
+
+        for name in self.components:
+            index = getattr(self, name)
+            if index is None:
+                continue
+
+            os.makedirs(tmp / name, exist_ok=True)
+            arrays = {}
+
+            for key, array in index.arrays().items():
+                array = np.asarray(array)
+                np.save(tmp / name / f"{key}.npy", array)
+                arrays[key] = {"dtype": array.dtype.str, "shape": array.shape}
+
+            manifest["components"][name] = arrays
+
+        with open(tmp / "manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        os.replace(tmp, path)
+        logger.success(f"Saved model snapshot {self.version} to {path}")
+        return path
+
+    def publish(self, root: Union[Path, str] = None, keep=3) -> None:
+        """atomically points CURRENT at this version and deletes all but the
+        newest keep snapshots"""
+        root = Path(root or SNAPSHOT_PATH)
+
+        tmp = root / "CURRENT.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.version)
+        os.replace(tmp, root / "CURRENT")
+
+        versions = sorted(
+            (p for p in root.iterdir() if p.is_dir() and p.name.isdigit()),
+            key=lambda p: int(p.name),
+        )
+        for old in versions[:-keep]:
+            if old.name != self.version:
+                shutil.rmtree(old, ignore_errors=True)
+
+        logger.success(f"Published model snapshot {self.version}")
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> "ModelSnapshot":
+        start = time.time()
+        path = Path(path)
+
+        with open(path / "manifest.json") as f:
+            manifest = json.load(f)
+
+        parts: Dict[str, object] = {}
+
+        for name, arrays in manifest["components"].items():
+            parts[name] = cls.components[name].from_arrays(
+                {
+                    key: np.load(path / name / f"{key}.npy", mmap_mode="r")
+                    for key in arrays
+                }
+            )
+
+        snapshot = cls(
+            manifest["version"],
+            manifest["catalog_version"],
+            manifest["weights"],
+            **parts,
+        )
+
+        logger.info(
+            f"Loaded model snapshot {snapshot.version} in {time.time() - start:.3f}s"
+        )
+        return snapshot
+
+    @staticmethod
+    def current_version(root: Union[Path, str] = None) -> Union[str, None]:
+        try:
+            with open(Path(root or SNAPSHOT_PATH) / "CURRENT") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def get_current(cls, root: Union[Path, str] = None) -> Union["ModelSnapshot", None]:
+        """the published snapshot, loaded again only when CURRENT changed. None
+        without one or when it is stale, then the indexes are built from sql."""
+        version = cls.current_version(root)
+
+        if version is None:
+            return None
+
+        with cls._lock:
+            if cls._current is None or cls._current.version != version:
+                cls._current = cls.load(Path(root or SNAPSHOT_PATH) / version)
+
+                if cls._current.catalog_version != catalog_version():
+                    logger.warning(
+                        f"Model snapshot {version} is older than the catalog, run 'flask buildsnapshot'"
+                    )
+
+            snapshot = cls._current
+
+        if snapshot.catalog_version != catalog_version():
+            return None
+
+        return snapshot
@@ -0,0 +1,230 @@
+from movie_recommender import INDEX_PATH
+from movie_recommender.indexes.rating_matrix import RatingMatrix
+from movie_recommender.utils import normalize_score
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Union
+import itertools
+import numpy as np
+import time
+import os
+
+
+class UserANNIndex:
+    """Random projection LSH over the taste vectors of the old users.
+
+    A taste vector is a row of the rating matrix minus the normalized default
+    value, so unrated movies are zero. Vectors are projected down to
+    `n_components` dims and hashed by the signs of `n_bits` random hyperplanes
+    in each of `n_tables` tables. A query only looks at its buckets (and the
+    buckets one, then two bits away) instead of at every old user.
+    """
+
+    default_path = INDEX_PATH / "user_ann_index.npz"
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        projection: np.ndarray,
+        hyperplanes: np.ndarray,
+        reduced: np.ndarray,
+        sorted_codes: np.ndarray,
+        order: np.ndarray,
+        default_vec_val: float,
+    ) -> None:
+        self.user_ids = user_ids
+        self.projection = projection
+        self.hyperplanes = hyperplanes
+        self.reduced = reduced
+        self.sorted_codes = sorted_codes
+        self.order = order
+        self.default_vec_val = float(default_vec_val)
+
+        # queries and how many of them scanned every user, see query
+        self.queries = 0
+        self.brute_forced = 0
+
+    @property
+    def n_tables(self) -> int:
+        return self.hyperplanes.shape[0]
+
+    @property
+    def n_bits(self) -> int:
+        return self.hyperplanes.shape[2]
+
+    @classmethod
+    def build(
+        cls,
+        matrix: RatingMatrix,
+        default_vec_val: float,
+        n_components=64,
+        n_tables=8,
+        n_bits=12,
+        seed=0,
+    ) -> "UserANNIndex":
+        start = time.time()
+        rng = np.random.default_rng(seed)
+
+        n_movies = matrix.shape[1]
+        padding = normalize_score(default_vec_val)
+
+        projection = rng.standard_normal((n_movies, n_components)).astype(
+            np.float32
+        ) / np.sqrt(n_components)
+
+        centered = matrix.values - matrix.rated.multiply(padding)
+        reduced = np.asarray(centered @ projection, dtype=np.float32)
+
+        hyperplanes = rng.standard_normal((n_tables, n_components, n_bits)).astype(
+            np.float32
+        )
+
+        codes = cls._hash(reduced, hyperplanes)
+        order = np.argsort(codes, axis=1, kind="stable").astype(np.int32)
+        sorted_codes = np.take_along_axis(codes, order, axis=1)
+
+        logger.info(
+            f"Built user ann index over {len(matrix.user_ids)} users in {time.time() - start:.2f}s"
+        )
+
+        return cls(
+            matrix.user_ids.copy(),
+            projection,
+            hyperplanes,
+            reduced,
+            sorted_codes,
+            order,
+            default_vec_val,
+        )
+
+    @staticmethod
+    def _hash(vectors: np.ndarray, hyperplanes: np.ndarray) -> np.ndarray:
+        """(n_tables, n_vectors) int64 bucket codes"""
+        bits = np.einsum("nd,tdb->tnb", vectors, hyperplanes) >= 0
+        weights = np.left_shift(1, np.arange(hyperplanes.shape[2], dtype=np.int64))
+        return (bits * weights).sum(axis=2)
+
+    def matches(self, matrix: RatingMatrix) -> bool:
+        """the index rows have to be the rows of the rating matrix"""
+        return self.projection.shape[0] == matrix.shape[1] and np.array_equal(
+            self.user_ids, matrix.user_ids
+        )
+
+    def reduce_query(self, columns: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """project a user given by normalized ratings at the matrix columns"""
+        centered = np.asarray(values, dtype=np.float32) - normalize_score(
+            self.default_vec_val
+        )
+        return centered @ self.projection[columns]
+
+    def _buckets(self, table: int, codes: np.ndarray) -> List[np.ndarray]:
+        sorted_codes = self.sorted_codes[table]
+        lo = np.searchsorted(sorted_codes, codes)
+        hi = np.searchsorted(sorted_codes, codes + 1)
+        return [self.order[table, l:h] for l, h in zip(lo, hi) if h > l]
+
+    def _probes(self) -> List[np.ndarray]:
+        """xor masks of the codes one and two bits away"""
+        bits = range(self.n_bits)
+        return [
+            np.array([1 << bit for bit in bits], dtype=np.int64),
+            np.array(
+                [(1 << a) | (1 << b) for a, b in itertools.combinations(bits, 2)],
+                dtype=np.int64,
+            ),
+        ]
+
+    def candidates(self, query: np.ndarray, n_candidates: int) -> np.ndarray:
+        """rows of old users that hash close to the reduced query"""
+        codes = self._hash(query[None, :], self.hyperplanes)[:, 0]
+
+        found = [
+            bucket
+            for t, code in enumerate(codes)
+            for bucket in self._buckets(t, codes[t : t + 1])
+        ]
+        rows = np.unique(np.concatenate(found)) if found else np.zeros(0, np.int32)
+
+        # multi probe the buckets further away until there are enough rows
+        for masks in self._probes():
+            if len(rows) >= n_candidates:
+                break
+
+            for t, code in enumerate(codes):
+                found.extend(self._buckets(t, code ^ masks))
+
+            if found:
+                rows = np.unique(np.concatenate(found))
+
+        return rows
+
+    def query(self, columns: np.ndarray, values: np.ndarray, k: int) -> np.ndarray:
+        """rows of the k old users closest to the query in the reduced space"""
+        query = self.reduce_query(columns, values)
+        rows = self.candidates(query, k)
+        self.queries += 1
+
+        if len(rows) < k:
+            # tiny or degenerate index, brute force is fine here. Often on a
+            # big index means there are too many bits for the users
+            rows = np.arange(len(self.user_ids), dtype=np.int32)
+            self.brute_forced += 1
+            logger.info(
+                f"User ann index scanned every user for {self.brute_forced} of {self.queries} queries"
+            )
+
+        distances = np.square(self.reduced[rows] - query).sum(axis=1)
+
+        if len(rows) > k:
+            best = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[best], distances[best]
+
+        return rows[np.argsort(distances)].astype(np.int32)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "user_ids": self.user_ids,
+            "projection": self.projection,
+            "hyperplanes": self.hyperplanes,
+            "reduced": self.reduced,
+            "sorted_codes": self.sorted_codes,
+            "order": self.order,
+            "default_vec_val": np.array(self.default_vec_val),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "UserANNIndex":
+        return cls(
+            arrays["user_ids"],
+            arrays["projection"],
+            arrays["hyperplanes"],
+            arrays["reduced"],
+            arrays["sorted_codes"],
+            arrays["order"],
+            float(arrays["default_vec_val"]),
+        )
+
+    def save(self, path: Union[Path, str] = None) -> Path:
+        path = Path(path or self.default_path)
+        os.makedirs(path.parent, exist_ok=True)
+
+        np.savez(path, **self.arrays())
+        logger.success(f"Saved user ann index to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Union[Path, str] = None) -> "UserANNIndex":
+        with np.load(Path(path or cls.default_path)) as data:
+            return cls.from_arrays(data)
+
+    @classmethod
+    def load_if_exists(
+        cls, path: Union[Path, str] = None
+    ) -> Union["UserANNIndex", None]:
+        path = Path(path or cls.default_path)
+
+        if not path.exists():
+            logger.info(f"No user ann index at {path}, run 'flask buildannindex'")
+            return None
+
+        return cls.load(path)
@@ -0,0 +1,55 @@
+from movie_recommender import INDEX_PATH
+from abc import ABC, abstractmethod
+import time
+import os
+
+CATALOG_VERSION_PATH = INDEX_PATH / "catalog.version"
+
+
+def catalog_version() -> str:
+    """changes every time 'flask initdb' reloads the movies"""
+    try:
+        with open(CATALOG_VERSION_PATH) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return "0"
+
+
+def bump_catalog_version() -> str:
+    os.makedirs(CATALOG_VERSION_PATH.parent, exist_ok=True)
+
+    version = str(time.time_ns())
+    with open(CATALOG_VERSION_PATH, "w") as f:
+        f.write(version)
+
+    return version
+
+
+class CatalogIndex(ABC):
+    """Process wide instance built from the db, rebuilt by get_instance as soon
+    as the catalog version changed. Subclasses implement from_db."""
+
+    _instance = None
+    catalog_version = None
+
+    @classmethod
+    @abstractmethod
+    def from_db(cls, db):
+        pass
+
+    @classmethod
+    def get_instance(cls, db=None):
+        version = catalog_version()
+
+        if cls._instance is None or cls._instance.catalog_version != version:
+            assert db is not None, "Building the index needs a db"
+            cls._instance = cls.from_db(db)
+            cls._instance.catalog_version = version
+
+        return cls._instance
+
+    @classmethod
+    def reload(cls, db):
+        cls._instance = cls.from_db(db)
+        cls._instance.catalog_version = catalog_version()
+        return cls._instance
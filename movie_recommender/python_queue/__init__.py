@@ -1 +1,9 @@
 from ._queue import BackgroundTaskQueue
+from .executors import JobExecutor, HTTPExecutor, UDSExecutor, ProcessExecutor
+from .status_store import (
+    JobStatus,
+    JobStatusStore,
+    MemoryStatusStore,
+    SQLiteStatusStore,
+)
+from .scheduler import JobScheduler, LANES
@@ -2,13 +2,26 @@ import subprocess
 from subprocess import Popen, PIPE, TimeoutExpired
 import threading
 import queue
+import math
+import time
 import sys
+from collections import deque
 from loguru import logger
-from movie_recommender import REPO_PATH, BACKGROUND_PORT
+from movie_recommender import (
+    REPO_PATH,
+    BACKGROUND_PORT,
+    BACKGROUND_WORKERS,
+    BACKGROUND_QUEUE_SIZE,
+    BULK_QUEUE_SIZE,
+)
 from requests import Timeout
 from hashlib import sha256
 import requests
 from movie_recommender.background_api.interface import BackgroundInterface
+from .status_store import JobStatusStore, default_status_store
+from .executors import JobExecutor, default_executor
+from .scheduler import JobScheduler, LANES
+from typing import Optional, Tuple
 
 
 class BackgroundTaskQueue:
@@ -22,56 +35,246 @@ class BackgroundTaskQueue:
         cls.instance = cls(*args, **kwargs)
         return cls.instance
 
-    def __init__(self, timeout=10) -> None:
-        self.task_queue = queue.Queue()
-        self.worker_thread = threading.Thread(target=self._worker)
-        self.running = True
-        self.worker_thread.start()
-        self.task_status = {}
+    def __init__(
+        self,
+        timeout=10,
+        workers=BACKGROUND_WORKERS,
+        maxsize=BACKGROUND_QUEUE_SIZE,
+        status_store: JobStatusStore = None,
+        executor: JobExecutor = None,
+    ) -> None:
+        # add_task raises queue.Full instead of queueing more than maxsize
+        # interactive jobs, bulk jobs wait in their own lane
+        self.scheduler = JobScheduler({"interactive": maxsize, "bulk": BULK_QUEUE_SIZE})
+        # shared with the other web workers when it is the sqlite store
+        self.task_status = status_store or default_status_store()
+        self.executor = executor or default_executor()
         self.timeout = timeout
 
-    def add_task(self, user_id):
+        self.lock = threading.Lock()
+        # notified on every status change, for the waiting event streams
+        self.status_changed = threading.Condition()
+        # jobs ever queued and ever started, their difference is the depth
+        self.enqueued = 0
+        self.started = 0
+        self.running_jobs = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.superseded = 0
+        # job id -> (number when it was queued, time it was queued, lane,
+        # position in the lane)
+        self.waiting = {}
+        # user id -> number of the users newest job, older jobs are superseded
+        self.latest = {}
+        # users with a running job and their job that waits for it to finish
+        self.running_users = set()
+        self.deferred = {}
+        # seconds of the last jobs, for the stats and the eta
+        self.wait_times = deque(maxlen=100)
+        self.run_times = deque(maxlen=100)
+
+        self.running = True
+        self.worker_threads = [
+            threading.Thread(target=self._worker, name=f"background-worker-{i}")
+            for i in range(workers)
+        ]
+        for worker_thread in self.worker_threads:
+            worker_thread.start()
+
+    def add_task(self, user_id, lane="interactive"):
+        """queues the job of the user in lane, interactive for jobs a user
+        waits for and bulk for backfills"""
         job_id = sha256(f"{user_id} and some random noise (:".encode()).hexdigest()
 
-        self.task_status[job_id] = "waiting"
-        self.task_queue.put((job_id, user_id))
+        with self.lock:
+            if job_id in self.waiting:
+                # the waiting job reads the newest ratings when it starts
+                self.coalesced += 1
+                logger.info(f"Coalesced the job of user {user_id}")
+                self._promote(job_id, user_id, lane)
+                return job_id
+
+            try:
+                position = self.scheduler.put_nowait(
+                    (job_id, user_id, self.enqueued), lane
+                )
+            except queue.Full:
+                self.rejected += 1
+                logger.warning(
+                    f"The {lane} lane is full, rejected the job of user {user_id}"
+                )
+                raise
+
+            if user_id in self.latest:
+                # a running job of the user is stale, only this one counts
+                self.superseded += 1
+                logger.info(f"Superseded the running job of user {user_id}")
+
+            self._set_status(job_id, "waiting")
+            self.waiting[job_id] = (self.enqueued, time.time(), lane, position)
+            self.latest[user_id] = self.enqueued
+            self.enqueued += 1
 
         return job_id
 
+    def _promote(self, job_id, user_id, lane):
+        """queues a waiting job again in lane if it has a higher priority,
+        whichever copy starts first runs the job"""
+        number, queued_at, waiting_lane, _ = self.waiting[job_id]
+
+        if LANES.index(lane) >= LANES.index(waiting_lane):
+            return
+
+        try:
+            position = self.scheduler.put_nowait((job_id, user_id, number), lane)
+        except queue.Full:
+            return
+
+        self.waiting[job_id] = (number, queued_at, lane, position)
+        logger.info(f"Moved the job of user {user_id} to the {lane} lane")
+
+    def estimate(self, job_id):
+        """(jobs ahead of it in its lane, seconds until it is done) of a
+        waiting job, the seconds are None until a job has finished"""
+        with self.lock:
+            if job_id not in self.waiting:
+                return None, None
+
+            _, _, lane, position = self.waiting[job_id]
+            run_time = self._mean(self.run_times)
+
+        ahead = self.scheduler.ahead(lane, position)
+
+        if run_time is None:
+            return ahead, None
+
+        # the workers take the jobs of the lane in rounds of as many as may
+        # run at once
+        slots = min(
+            len(self.worker_threads),
+            self.scheduler.max_running[lane] or len(self.worker_threads),
+        )
+        rounds = math.ceil((ahead + 1) / slots)
+        return ahead, rounds * run_time
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": len(self.worker_threads),
+                "capacity": self.scheduler.maxsize["interactive"],
+                "depth": self.enqueued - self.started,
+                "running": self.running_jobs,
+                "rejected": self.rejected,
+                "coalesced": self.coalesced,
+                "superseded": self.superseded,
+                "mean_wait_seconds": self._mean(self.wait_times),
+                "max_wait_seconds": max(self.wait_times, default=None),
+                "mean_run_seconds": self._mean(self.run_times),
+                "lanes": self.scheduler.stats(),
+                "executor": self.executor.stats(),
+            }
+
+    def wait_for_change(self, timeout: float) -> bool:
+        """blocks until any job changed its status, False after timeout"""
+        with self.status_changed:
+            return self.status_changed.wait(timeout)
+
+    def _set_status(self, job_id, state, error=None):
+        self.task_status.update(job_id, state, error)
+        with self.status_changed:
+            self.status_changed.notify_all()
+
+    @staticmethod
+    def _mean(times):
+        return sum(times) / len(times) if times else None
+
     def shutdown(self):
-        self.running = False  # Signal the worker to stop
-        self.task_queue.put((None, None))  # Add a sentinel task to unblock the queue
-        self.worker_thread.join()
+        self.running = False  # Signal the workers to stop
+        # unblocks the workers waiting for a job
+        self.scheduler.close()
+        for worker_thread in self.worker_threads:
+            worker_thread.join()
+        self.executor.close()
 
     def _worker(self):
         main_thread = threading.main_thread()
         while main_thread.is_alive() and self.running:
-            job_id, user_id = self.task_queue.get()
-            if user_id is None:
+            lane, job = self.scheduler.get()
+            if lane is None:
                 break
-            self._process_task(job_id, user_id)
-            self.task_queue.task_done()
 
-    def _process_task(self, job_id, user_id):
+            try:
+                # a job the user queued while this one ran follows right away
+                while job is not None:
+                    job = self._run_job(*job)
+            finally:
+                self.scheduler.task_done(lane)
+
+    def _run_job(self, job_id, user_id, number):
+        """runs the job and returns the deferred next job of the user"""
+        with self.lock:
+            if self.waiting.get(job_id, (None,))[0] != number:
+                # the copy in the other lane of a promoted job ran already
+                return None
+
+            if user_id in self.running_users:
+                # two jobs of a user would both replace the recommendations,
+                # the running one starts this one once it is done
+                self.deferred[user_id] = (job_id, user_id, number)
+                return None
+
+            _, queued_at, _, _ = self.waiting.pop(job_id)
+            self.running_users.add(user_id)
+            self.started += 1
+            self.running_jobs += 1
+            self.wait_times.append(time.time() - queued_at)
+
+        start = time.time()
+        self._set_status(job_id, "running")
+        status, error = self._process_task(job_id, user_id)
+
+        with self.lock:
+            self.running_jobs -= 1
+            self.run_times.append(time.time() - start)
+            self.running_users.discard(user_id)
+
+            if self.latest.get(user_id) == number:
+                del self.latest[user_id]
+                self._set_status(job_id, status, error)
+            else:
+                # the job id is shared with the follow up, keep its status
+                logger.info(f"Discarded the superseded job of user {user_id}")
+
+            return self.deferred.pop(user_id, None)
+
+    def _process_task(self, job_id, user_id) -> Tuple[str, Optional[str]]:
+        """runs the job and returns its status and error"""
         try:
-            if not BackgroundInterface.check_health(self.timeout):
-                raise Exception("The Helper Api is down")
+            result = self.executor.run(user_id, self.timeout)
+            if result == "superseded":
+                # only kept when no newer job of the user is queued here
+                logger.warning(f"The ratings of user {user_id} changed during the job")
+                return "error", "Your ratings changed meanwhile, please save them again"
 
-            success = BackgroundInterface.commit_job(user_id, self.timeout)
-            if not success:
-                self.task_status[job_id] = "error"
+            if result != "success":
                 logger.error(f"Background Process Failed for ID {user_id}")
-            else:
-                self.task_status[job_id] = "success"
-                logger.success(f"Background Process for ID {user_id}")
+                return "error", "Background Process Failed"
 
-        except Timeout:
-            self.task_status[job_id] = "error"
+            logger.success(f"Background Process for ID {user_id}")
+            return "success", None
+
+        except (Timeout, TimeoutError):
             logger.error(f"Timeout. Job for User {user_id} exceeded {self.timeout}s")
+            return "error", f"Timeout after {self.timeout}s"
+
+        # a missing or refused socket of the UDSExecutor
+        except (requests.ConnectionError, ConnectionError, FileNotFoundError) as e:
+            logger.error(f"The Helper Api is down: {e}")
+            return "error", "The Helper Api is down"
 
         except Exception as e:
-            self.task_status[job_id] = "error"
             logger.error(f"Error {e} for User {user_id}")
+            return "error", str(e)
 
     # def _process_task(self, job_id, user_id):
     #     process = Popen(
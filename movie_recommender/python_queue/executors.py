@@ -0,0 +1,181 @@
+from movie_recommender import (
+    BACKGROUND_PORT,
+    BACKGROUND_WORKERS,
+    BACKGROUND_EXECUTOR,
+    BACKGROUND_SOCKET,
+)
+from movie_recommender.background_api.interface import UnixHTTPConnection
+from movie_recommender.background_api import jobs
+from movie_recommender.apps import create_app_slimm
+from concurrent.futures import ProcessPoolExecutor
+from abc import ABC, abstractmethod
+from concurrent import futures
+from requests.adapters import HTTPAdapter
+from loguru import logger
+import multiprocessing
+import threading
+import requests
+import json
+
+
+class JobExecutor(ABC):
+    """Runs the recommendation job of a user for the BackgroundTaskQueue.
+    run returns the result of generate_recommendations (success, error or
+    superseded) and raises TimeoutError or requests.Timeout after timeout
+    seconds."""
+
+    @abstractmethod
+    def run(self, user_id: int, timeout: float) -> str:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class HTTPExecutor(JobExecutor):
+    """posts to the background api, over pooled keep-alive connections"""
+
+    def __init__(
+        self, url=f"http://localhost:{BACKGROUND_PORT}", pool_size=BACKGROUND_WORKERS
+    ) -> None:
+        self.url = url
+        self.session = requests.Session()
+        # one connection per queue worker
+        self.session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
+
+    def run(self, user_id: int, timeout: float) -> str:
+        response = self.session.post(
+            f"{self.url}/calculate_recommendations/",
+            params={"user_id": user_id},
+            timeout=timeout,
+        )
+        response.raise_for_status()  # Raise an HTTPError for bad requests
+        return response.json()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class UDSExecutor(JobExecutor):
+    """posts to a background api started with uvicorn --uds, no tcp stack and
+    one kept alive connection per queue worker"""
+
+    def __init__(self, socket_path=BACKGROUND_SOCKET) -> None:
+        self.socket_path = str(socket_path)
+        self.local = threading.local()
+
+    def run(self, user_id: int, timeout: float) -> str:
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = UnixHTTPConnection(self.socket_path)
+            self.local.connection = connection
+
+        connection.timeout = timeout
+
+        try:
+            connection.request(
+                "POST", f"/calculate_recommendations/?user_id={int(user_id)}"
+            )
+            response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            # reconnect with the next job
+            connection.close()
+            self.local.connection = None
+            raise
+
+        if response.status != 200:
+            raise Exception(f"Background api answered {response.status}: {body}")
+
+        return json.loads(body)
+
+
+# the db of a worker process of the ProcessExecutor, set by _init_process
+_process_db = None
+
+
+def _init_process():
+    global _process_db
+
+    app, _process_db = create_app_slimm()
+    jobs.load_models(_process_db)
+
+
+def _run_in_process(user_id: int) -> str:
+    return jobs.generate_recommendations(_process_db, user_id)
+
+
+class ProcessExecutor(JobExecutor):
+    """Runs generate_recommendations in a pool of worker processes, without
+    the background api. Every worker loads the models once at its start."""
+
+    def __init__(self, workers=BACKGROUND_WORKERS) -> None:
+        self.workers = workers
+        # jobs that timed out but still hold a worker process
+        self.overrunning = set()
+        self.timed_out = 0
+        self.lock = threading.Lock()
+
+        self.pool = ProcessPoolExecutor(
+            workers,
+            # forking the threaded web api would copy locks held by other
+            # threads, spawned workers start clean
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+        )
+
+        # starts the workers now, loading the models takes a while
+        for _ in range(workers):
+            self.pool.submit(int)
+
+    def run(self, user_id: int, timeout: float) -> str:
+        with self.lock:
+            # the job would only wait for a worker until its timeout
+            if len(self.overrunning) >= self.workers:
+                raise TimeoutError("All workers still run timed out jobs")
+
+        future = self.pool.submit(_run_in_process, user_id)
+
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            # the worker finishes the job anyway, it can not be interrupted
+            if not future.cancel():
+                with self.lock:
+                    self.timed_out += 1
+                    self.overrunning.add(future)
+                future.add_done_callback(self._finished_overrun)
+
+            raise TimeoutError(f"Job of user {user_id} took longer than {timeout}s")
+
+    def _finished_overrun(self, future) -> None:
+        with self.lock:
+            self.overrunning.discard(future)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "overrunning": len(self.overrunning),
+                "timed_out": self.timed_out,
+            }
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def default_executor() -> JobExecutor:
+    """the executor named by BACKGROUND_EXECUTOR in the .env, http by default"""
+    logger.info(f"Background jobs run with the {BACKGROUND_EXECUTOR} executor")
+
+    if BACKGROUND_EXECUTOR == "process":
+        return ProcessExecutor()
+    if BACKGROUND_EXECUTOR == "uds":
+        return UDSExecutor()
+    return HTTPExecutor()
@@ -1,5 +1,6 @@
 from movie_recommender.querying.sql_models import Rating, Recommendation, User
 from movie_recommender.recommenders import CombinedRecommender
+from movie_recommender.indexes import MovieCatalog
 import time
 from movie_recommender import REPO_PATH
 import sys
@@ -26,7 +27,11 @@ def generate_recommendations(db, user_id):
         db.session.query(Recommendation).filter_by(user_id=user_id).delete()
         db.session.commit()
 
-        ratings = db.session.query(Rating).filter_by(user_id=user_id).all()
+        ratings = (
+            db.session.query(Rating.movie_id, Rating.value)
+            .filter_by(user_id=user_id)
+            .all()
+        )
 
         if not ratings:
             message = f"No ratings found for user ID {user_id}."
@@ -34,15 +39,17 @@ def generate_recommendations(db, user_id):
             logger.error(message)
             sys.exit(1)
 
-        movies, ratings = zip(*[(r.movie, r.value) for r in ratings])
-        ratings = [(val - 3) ** 3 for val in ratings]
+        catalog = MovieCatalog.get_instance(db)
 
-        recommender = CombinedRecommender(db)
+        movies, ratings = catalog.rated(*zip(*ratings))
+        ratings = (ratings - 3) ** 3
+
+        recommender = CombinedRecommender(db, catalog)
         recommendations, scores = recommender.find_most_simmilar(movies, ratings)
 
-        for movie, score in zip(recommendations, scores):
+        for movie_id, score in zip(catalog.movie_ids[recommendations], scores):
             new_recommendation = Recommendation(
-                user_id=user_id, movie_id=movie.id, score=float(score), movie=movie
+                user_id=user_id, movie_id=int(movie_id), score=float(score)
             )
             db.session.add(new_recommendation)
 
@@ -0,0 +1,165 @@
+from movie_recommender import (
+    BACKGROUND_QUEUE_SIZE,
+    BULK_QUEUE_SIZE,
+    BULK_MAX_RUNNING,
+    BULK_MAX_WAIT,
+)
+from collections import deque
+from typing import Dict, Optional, Tuple
+import threading
+import queue
+import math
+import time
+
+# in the order their jobs are started
+LANES = ("interactive", "bulk")
+
+
+class JobScheduler:
+    """Jobs in priority lanes instead of one fifo queue.
+
+    Interactive jobs, from save_ratings, always start first. Bulk jobs like
+    backfills run when no interactive job waits and at most max_running["bulk"]
+    at once, so some workers are always left for the interactive ones. Once a
+    lane has not started a job for max_wait seconds its next job goes first,
+    bulk work is slowed down by interactive jobs but never stopped.
+    """
+
+    def __init__(
+        self,
+        maxsize: Dict[str, int] = None,
+        max_running: Dict[str, Optional[int]] = None,
+        max_wait: float = BULK_MAX_WAIT,
+    ) -> None:
+        self.maxsize = maxsize or {
+            "interactive": BACKGROUND_QUEUE_SIZE,
+            "bulk": BULK_QUEUE_SIZE,
+        }
+        # None for no cap
+        self.max_running = max_running or {
+            "interactive": None,
+            "bulk": BULK_MAX_RUNNING,
+        }
+        self.max_wait = max_wait
+
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # lane -> (time it was queued, item)
+        self.waiting = {lane: deque() for lane in LANES}
+        self.running = {lane: 0 for lane in LANES}
+        # items ever put into and taken from the lane, their difference is
+        # how many wait ahead of an item
+        self.enqueued = {lane: 0 for lane in LANES}
+        self.dequeued = {lane: 0 for lane in LANES}
+        self.last_started = {lane: time.time() for lane in LANES}
+        # jobs started ahead of their turn by max_wait
+        self.promoted = {lane: 0 for lane in LANES}
+        # seconds the last jobs of the lane waited
+        self.wait_times = {lane: deque(maxlen=100) for lane in LANES}
+
+    def put_nowait(self, item, lane: str = "interactive") -> int:
+        """queues item and returns its position in the lane, raises
+        queue.Full when the lane holds maxsize items"""
+        with self.condition:
+            if len(self.waiting[lane]) >= self.maxsize[lane]:
+                raise queue.Full()
+
+            self.waiting[lane].append((time.time(), item))
+            position = self.enqueued[lane]
+            self.enqueued[lane] += 1
+            self.condition.notify()
+
+        return position
+
+    def get(self) -> Tuple[Optional[str], object]:
+        """blocks until a job may start and returns its lane and item,
+        (None, None) once the scheduler is closed"""
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None, None
+
+                lane = self._next_lane()
+                if lane is not None:
+                    break
+
+                self.condition.wait()
+
+            now = time.time()
+            queued_at, item = self.waiting[lane].popleft()
+
+            self.dequeued[lane] += 1
+            self.running[lane] += 1
+            self.last_started[lane] = now
+            self.wait_times[lane].append(now - queued_at)
+
+        return lane, item
+
+    def task_done(self, lane: str) -> None:
+        with self.condition:
+            self.running[lane] -= 1
+            # a capped lane may start its next job now
+            self.condition.notify()
+
+    def _next_lane(self) -> Optional[str]:
+        startable = [
+            lane
+            for lane in LANES
+            if self.waiting[lane]
+            and (
+                self.max_running[lane] is None
+                or self.running[lane] < self.max_running[lane]
+            )
+        ]
+        now = time.time()
+
+        for lane in startable:
+            # waiting since the head was queued or the lane last started one
+            starved = now - max(self.waiting[lane][0][0], self.last_started[lane])
+
+            if lane != startable[0] and starved > self.max_wait:
+                self.promoted[lane] += 1
+                return lane
+
+        return startable[0] if startable else None
+
+    def ahead(self, lane: str, position: int) -> int:
+        """items of the lane that start before the one at position"""
+        with self.condition:
+            return max(position - self.dequeued[lane], 0)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                lane: {
+                    "depth": len(self.waiting[lane]),
+                    "capacity": self.maxsize[lane],
+                    "running": self.running[lane],
+                    "max_running": self.max_running[lane],
+                    "promoted": self.promoted[lane],
+                    **self._latency(self.wait_times[lane]),
+                }
+                for lane in LANES
+            }
+
+    @staticmethod
+    def _latency(times) -> dict:
+        if not times:
+            return {
+                "mean_wait_seconds": None,
+                "p95_wait_seconds": None,
+                "max_wait_seconds": None,
+            }
+
+        ordered = sorted(times)
+        return {
+            "mean_wait_seconds": sum(ordered) / len(ordered),
+            "p95_wait_seconds": ordered[math.ceil(0.95 * len(ordered)) - 1],
+            "max_wait_seconds": ordered[-1],
+        }
@@ -0,0 +1,161 @@
+from movie_recommender import JOB_STATUS_DB, JOB_STATUS_TTL
+from dataclasses import dataclass, asdict
+from abc import ABC, abstractmethod
+from cachetools import TTLCache
+from pathlib import Path
+from typing import Optional, Union
+import threading
+import sqlite3
+import time
+import os
+
+
+@dataclass(slots=True)
+class JobStatus:
+    """waiting, running, success or error and when it got there"""
+
+    state: str
+    queued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def moved_to(self, state: str, error: str = None) -> "JobStatus":
+        """the record after the job reached state now"""
+        now = time.time()
+
+        if state == "waiting":
+            return JobStatus(state, queued_at=now)
+        if state == "running":
+            return JobStatus(state, self.queued_at, started_at=now)
+
+        return JobStatus(state, self.queued_at, self.started_at, now, error)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "duration": self.duration}
+
+
+class JobStatusStore(ABC):
+    """Status of the background jobs by job id, records expire ttl seconds
+    after their last update. Subclasses implement get and _put."""
+
+    def __init__(self, ttl: float = JOB_STATUS_TTL) -> None:
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        pass
+
+    @abstractmethod
+    def _put(self, job_id: str, status: JobStatus) -> None:
+        pass
+
+    def update(self, job_id: str, state: str, error: str = None) -> JobStatus:
+        previous = self.get(job_id) or JobStatus(state)
+        status = previous.moved_to(state, error)
+        self._put(job_id, status)
+        return status
+
+
+class MemoryStatusStore(JobStatusStore):
+    """only visible to this process, the default"""
+
+    def __init__(self, ttl: float = JOB_STATUS_TTL, maxsize=100_000) -> None:
+        super().__init__(ttl)
+        self.lock = threading.Lock()
+        self.records = TTLCache(maxsize, ttl)
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self.lock:
+            return self.records.get(job_id)
+
+    def _put(self, job_id: str, status: JobStatus) -> None:
+        with self.lock:
+            self.records[job_id] = status
+
+
+class SQLiteStatusStore(JobStatusStore):
+    """A WAL mode sqlite file, so every web worker reads the status of the jobs
+    the others queued while one of them writes"""
+
+    # expired rows are deleted every this many updates
+    evict_every = 256
+
+    def __init__(self, path: Union[Path, str], ttl: float = JOB_STATUS_TTL) -> None:
+        super().__init__(ttl)
+        self.path = str(path)
+        os.makedirs(Path(path).parent, exist_ok=True)
+
+        # sqlite connections must not be shared between threads
+        self.local = threading.local()
+        self.updates = 0
+
+        with self.connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS job_status (
+                    job_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    queued_at REAL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT,
+                    updated_at REAL NOT NULL
+                )""")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS job_status_updated ON job_status (updated_at)"
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # nor between forked web workers
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=10)
+            self.local.connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT state, queued_at, started_at, finished_at, error FROM job_status WHERE job_id = ? AND updated_at > ?",
+                (job_id, time.time() - self.ttl),
+            )
+            .fetchone()
+        )
+        return JobStatus(*row) if row is not None else None
+
+    def _put(self, job_id: str, status: JobStatus) -> None:
+        now = time.time()
+
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO job_status VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    status.state,
+                    status.queued_at,
+                    status.started_at,
+                    status.finished_at,
+                    status.error,
+                    now,
+                ),
+            )
+
+            self.updates += 1
+            if self.updates % self.evict_every == 0:
+                connection.execute(
+                    "DELETE FROM job_status WHERE updated_at <= ?", (now - self.ttl,)
+                )
+
+
+def default_status_store() -> JobStatusStore:
+    """sqlite when JOB_STATUS_DB is set in the .env, in memory otherwise"""
+    if JOB_STATUS_DB:
+        return SQLiteStatusStore(JOB_STATUS_DB)
+    return MemoryStatusStore()
@@ -1,5 +1,6 @@
 from movie_recommender.querying.sql_models import Movie
 from movie_recommender import REPO_PATH, CHROMA_PORT
+from movie_recommender.indexes.plot_embeddings import PlotEmbeddingMatrix
 import chromadb
 import tqdm
 import math
@@ -41,6 +42,9 @@ class CHROMA_Manager:
         )
         self.batchsize = batchsize
 
+        # set by cache_embeddings, answers plot queries without chroma
+        self.embedding_matrix: PlotEmbeddingMatrix = None
+
     def get_set_movies(self):
         return set(self.collection.get()["ids"])
 
@@ -74,6 +78,22 @@ class CHROMA_Manager:
             documents = [i.imdb_data.summary for i in items]
             self.collection.add(ids=ids, documents=documents)
 
+        if new_movies:
+            self.cache_embeddings(rebuild=True)
+
+    def cache_embeddings(self, rebuild=False) -> PlotEmbeddingMatrix:
+        """opens the exported plot embeddings, exports them first if they are
+        missing or the collection changed size since"""
+        if not rebuild and PlotEmbeddingMatrix.exists():
+            matrix = PlotEmbeddingMatrix.load()
+
+            if len(matrix) == self.collection.count():
+                self.embedding_matrix = matrix
+                return matrix
+
+        self.embedding_matrix = PlotEmbeddingMatrix.export(self.collection)
+        return self.embedding_matrix
+
     def query(
         self, movie_id: int, top_k
     ) -> Tuple[List[int], List[int],]:
@@ -92,3 +112,52 @@ class CHROMA_Manager:
         similarity = [1 - i for i in distances]
 
         return ids, similarity
+
+    def query_many(self, movie_ids: List[int], top_k) -> List[Dict[int, float]]:
+        """like query for many movies with one get and one query, returns an
+        id -> similarity map per input (empty if there is no embedding).
+        With cached embeddings chroma is not asked at all, the cache holds the
+        whole collection."""
+        if self.embedding_matrix is not None:
+            if self.embedding_matrix.changed_on_disk():
+                # another process ran fill and exported again
+                self.embedding_matrix = PlotEmbeddingMatrix.load()
+
+            return self.embedding_matrix.query_many(movie_ids, top_k)
+
+        return self._query_chroma(movie_ids, top_k)
+
+    def _query_chroma(self, movie_ids: List[int], top_k) -> List[Dict[int, float]]:
+        results: List[Dict[int, float]] = [{} for _ in movie_ids]
+
+        if not movie_ids:
+            return results
+
+        found = self.collection.get(
+            ids=list({str(i) for i in movie_ids}), include=["embeddings"]
+        )
+        embeddings = dict(zip(found["ids"], found["embeddings"]))
+
+        missing = [i for i in movie_ids if str(i) not in embeddings]
+        if missing:
+            logger.info(f"No embedding for {missing}")
+
+        queried = [i for i in movie_ids if str(i) in embeddings]
+        if not queried:
+            return results
+
+        res = self.collection.query(
+            query_embeddings=[embeddings[str(i)] for i in queried],
+            n_results=top_k + 1,
+        )
+
+        by_movie = {}
+        for movie_id, ids, distances in zip(queried, res["ids"], res["distances"]):
+            similar = {
+                int(other): 1 - distance
+                for other, distance in zip(ids, distances)
+                if int(other) != movie_id
+            }
+            by_movie[movie_id] = dict(list(similar.items())[:top_k])
+
+        return [by_movie.get(i, {}) for i in movie_ids]
@@ -50,6 +50,15 @@ class Recommendation(db.Model):
     movie = db.relationship("Movie", back_populates="recommendations", uselist=False)
 
 
+class UserScores(db.Model):
+    __tablename__ = "user_scores"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    # the catalog whose positions the scores are over
+    catalog_version = db.Column(db.String(32))
+    # float32 recommendation score of every catalog position
+    scores = db.Column(db.LargeBinary)
+
+
 class Rating(db.Model):
     __tablename__ = "ratings"
     id = db.Column(db.Integer, primary_key=True)
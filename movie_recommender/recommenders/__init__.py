@@ -1 +1,5 @@
 from .combined_recommender import CombinedRecommender
+from .item_based_recommender import ItemBasedRecommender
+from .factor_recommender import FactorRecommender
+from .incremental import RecommenderState
+from .batch import BatchRecommender
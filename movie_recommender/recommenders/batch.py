@@ -0,0 +1,164 @@
+from movie_recommender.querying.sql_models import (
+    Rating,
+    Recommendation,
+    User,
+    UserScores,
+)
+from movie_recommender.indexes import MovieCatalog
+from .combined_recommender import CombinedRecommender
+from .dense import stored_recommendations, score_blob
+from sqlalchemy import insert
+from scipy import sparse
+from loguru import logger
+from typing import List, Tuple
+import numpy as np
+import tqdm
+import time
+
+
+class BatchRecommender:
+    """Recomputes the recommendations of many users at once, e.g. after a
+    catalog reload or a weight change.
+
+    All ratings are loaded as one users x catalog matrix. Components with
+    batch_scoring score a chunk of users with sparse matrix products, the
+    others row by row. The rows are written with bulk inserts.
+    """
+
+    def __init__(self, recommender: CombinedRecommender) -> None:
+        self.recommender = recommender
+        self.catalog: MovieCatalog = recommender.catalog
+
+    @staticmethod
+    def rated_users(db) -> List[int]:
+        """ids of every user with ratings"""
+        rows = (
+            db.session.query(Rating.user_id)
+            .filter(Rating.user_id.isnot(None))
+            .distinct()
+            .order_by(Rating.user_id)
+            .all()
+        )
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def load_ratings(
+        db, catalog: MovieCatalog, user_ids: List[int] = None
+    ) -> Tuple[np.ndarray, sparse.csr_matrix]:
+        """ids of the users and their transformed ratings as users x catalog"""
+        query = db.session.query(Rating.user_id, Rating.movie_id, Rating.value).filter(
+            Rating.user_id.isnot(None)
+        )
+
+        if user_ids is not None:
+            query = query.filter(Rating.user_id.in_(user_ids))
+
+        rows = np.array(query.all(), dtype=np.float64).reshape(-1, 3)
+
+        positions = catalog.positions(rows[:, 1].astype(np.int64))
+        rows = rows[positions >= 0]
+        positions = positions[positions >= 0]
+
+        users, user_rows = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+        # the same transformation as the single user jobs
+        values = ((rows[:, 2] - 3) ** 3).astype(np.float32)
+
+        ratings = sparse.csr_matrix(
+            (values, (user_rows, positions)), shape=(len(users), len(catalog))
+        )
+        return users, ratings
+
+    def score(self, ratings: sparse.csr_matrix) -> np.ndarray:
+        """fused scores of every row of ratings, like CombinedRecommender.score"""
+        recommender = self.recommender
+        totals = np.zeros(ratings.shape, dtype=np.float32)
+
+        for name, component in recommender.components.items():
+            start = time.time()
+
+            if getattr(component, "batch_scoring", False):
+                scores = component.get_batch_total_scores(ratings)
+            else:
+                scores = np.stack(
+                    [
+                        component.get_total_scores(
+                            ratings.indices[begin:end], ratings.data[begin:end]
+                        )
+                        for begin, end in zip(ratings.indptr[:-1], ratings.indptr[1:])
+                    ]
+                )
+
+            # components only ever contributed their positive scores
+            np.maximum(scores, 0, out=scores)
+            totals += recommender.weights[name] * scores
+
+            logger.debug(
+                f"{name.capitalize()} Based Recommendation of {ratings.shape[0]} users took {time.time() - start}"
+            )
+
+        return totals
+
+    def write(
+        self, db, user_ids: np.ndarray, ratings: sparse.csr_matrix, totals: np.ndarray
+    ) -> None:
+        """replaces the recommendations and scores of the users"""
+        catalog = self.catalog
+        user_ids = [int(user_id) for user_id in user_ids]
+
+        recommendations, scores = [], []
+
+        for user_id, movies, user_totals in zip(
+            user_ids, np.split(ratings.indices, ratings.indptr[1:-1]), totals
+        ):
+            stored = stored_recommendations(user_totals, movies, catalog)
+
+            recommendations.extend(
+                {"user_id": user_id, "movie_id": int(movie_id), "score": float(score)}
+                for movie_id, score in zip(
+                    catalog.movie_ids[stored], user_totals[stored]
+                )
+            )
+            scores.append(
+                {
+                    "user_id": user_id,
+                    "catalog_version": catalog.catalog_version,
+                    "scores": score_blob(user_totals, movies),
+                }
+            )
+
+        for model in (Recommendation, UserScores):
+            db.session.query(model).filter(model.user_id.in_(user_ids)).delete(
+                synchronize_session=False
+            )
+
+        if recommendations:
+            db.session.execute(insert(Recommendation), recommendations)
+        db.session.execute(insert(UserScores), scores)
+
+        db.session.query(User).filter(User.id.in_(user_ids)).update(
+            {User.recommendations_ready: True}, synchronize_session=False
+        )
+        db.session.commit()
+
+    def run(self, db, user_ids: List[int] = None, chunksize=256) -> int:
+        """recomputes the given users or everyone with ratings, returns how
+        many users were recomputed"""
+        start = time.time()
+
+        user_ids, ratings = self.load_ratings(db, self.catalog, user_ids)
+        logger.info(
+            f"Loaded {ratings.nnz} ratings of {len(user_ids)} users in {time.time() - start:.2f}s"
+        )
+
+        for chunk_start in tqdm.tqdm(
+            range(0, len(user_ids), chunksize), "Batch recommendations"
+        ):
+            chunk = slice(chunk_start, chunk_start + chunksize)
+            totals = self.score(ratings[chunk])
+            self.write(db, user_ids[chunk], ratings[chunk], totals)
+
+        elapsed = time.time() - start
+        logger.success(
+            f"Recomputed {len(user_ids)} users in {elapsed:.2f}s, {len(user_ids) / max(elapsed, 1e-9):.1f} users per second"
+        )
+        return len(user_ids)
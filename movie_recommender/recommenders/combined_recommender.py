@@ -1,10 +1,16 @@
 from .content_based_recommender import ContentBasedRecommender
 from .user_based_recommender import UserBasedRecommender
+from .item_based_recommender import ItemBasedRecommender
+from .factor_recommender import FactorRecommender
+from .incremental import RecommenderState
+from .dense import rank_dense_scores
 from movie_recommender.utils import normalize_score, l2
+from movie_recommender.indexes import MovieCatalog, ModelSnapshot
 from typing import List, Set, Dict, Tuple
-from movie_recommender.querying.sql_models import Movie
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
 from loguru import logger
+import numpy as np
 import time
 
 
@@ -12,6 +18,10 @@ class CombinedRecommender:
     weights = {
         "user": 31.696782262221,
         "content": 15.069030305424,
+        # not tuned with optuna yet, off until they are so building their
+        # models does not change the recommendations
+        "item": 0.0,
+        "factor": 0.0,
         "user_weights": {
             "default_vec_val": 2.5,
             "closest_relevant_users": 4,
@@ -23,44 +33,197 @@ class CombinedRecommender:
         },
     }
 
-    def __init__(self, db, distance_metric=l2) -> None:
-        UserBasedRecommender.weights = self.weights["user_weights"]
-        ContentBasedRecommender.weights = self.weights["content_weights"]
+    # shared by all recommenders, the components mostly wait on sql or numpy
+    # which both release the gil
+    executor: ThreadPoolExecutor = None
+
+    def __init__(
+        self,
+        db,
+        catalog: MovieCatalog,
+        distance_metric="l2",
+        rating_matrix=None,
+        ann_index=None,
+        item_similarity=None,
+        factor_model=None,
+        credit_index=None,
+        plot_neighbours=None,
+        parallel: bool = False,
+        weights: dict = None,
+        model_version: str = None,
+    ) -> None:
+        """distance_metric is a name from utils.DISTANCE_METRICS, a BatchedMetric
+        or a per pair callable like utils.l2. All components score catalog
+        positions. With parallel the components run concurrently on a thread
+        pool, each with its own db session."""
+        if weights is not None:
+            self.weights = weights
+
+        # the component states of a job are only reused with the same version
+        self.model_version = model_version or catalog.catalog_version
+
+        self.db = db
+        self.catalog = catalog
+        self.parallel = parallel
 
         self.user_based_recommender = UserBasedRecommender(
-            db, distance_metric=distance_metric
+            db,
+            catalog,
+            distance_metric=distance_metric,
+            rating_matrix=rating_matrix,
+            ann_index=ann_index,
+            weights=self.weights["user_weights"],
+        )
+        self.content_based_recommender = ContentBasedRecommender(
+            catalog,
+            credit_index,
+            plot_neighbours=plot_neighbours,
+            weights=self.weights["content_weights"],
+        )
+
+        # every component is weighted by weights[name]
+        self.components = {
+            "user": self.user_based_recommender,
+            "content": self.content_based_recommender,
+        }
+
+        # a component without weight is not scored at all
+        if item_similarity is not None and self.weights.get("item"):
+            self.components["item"] = ItemBasedRecommender(catalog, item_similarity)
+
+        if factor_model is not None and self.weights.get("factor"):
+            self.components["factor"] = FactorRecommender(catalog, factor_model)
+
+    @classmethod
+    def from_snapshot(
+        cls, db, snapshot: ModelSnapshot, parallel: bool = False
+    ) -> "CombinedRecommender":
+        """every index, model and weight from one model snapshot"""
+        return cls(
+            db,
+            snapshot.catalog,
+            rating_matrix=snapshot.rating_matrix,
+            ann_index=snapshot.ann_index,
+            item_similarity=snapshot.item_similarity,
+            factor_model=snapshot.factor_model,
+            credit_index=snapshot.credit_index,
+            plot_neighbours=snapshot.plot_neighbours,
+            parallel=parallel,
+            weights=snapshot.weights,
+            model_version=snapshot.version,
         )
-        self.content_based_recommender = ContentBasedRecommender()
 
     def find_most_simmilar(
-        self, movies: List[Movie], ratings: List[float]
-    ) -> Tuple[List[Movie], List[float]]:
-        start = time.time()
-        user_based = self.user_based_recommender.find_most_simmilar(movies, ratings)
-        logger.debug(f"User Based Recommendation took {time.time() - start}")
+        self,
+        movies: np.ndarray,
+        ratings: np.ndarray,
+        state: RecommenderState = None,
+        top_n: int = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """movies are the catalog positions of the rated movies, returns the
+        recommended catalog positions and their scores. Only the best top_n
+        are ranked, without it the full ranking is returned."""
+        recommendations = self.score(movies, ratings, state=state)
+
+        return rank_dense_scores(recommendations, movies, top_n)
+
+    def score(
+        self,
+        movies: np.ndarray,
+        ratings: np.ndarray,
+        state: RecommenderState = None,
+    ) -> np.ndarray:
+        """the fused float32 score of every catalog position, the inputs are
+        not removed.
+
+        With the state of the users last job only the rating changes are
+        scored by the linear components, the state is updated in place"""
+        if state is not None:
+            state.begin(movies, ratings)
+
+        names = list(self.components)
+        totals = np.empty((len(names), len(self.catalog)), dtype=np.float32)
+
+        if self.parallel:
+            results = self.run_parallel(names, movies, ratings, state)
+        else:
+            results = (
+                self.timed_component_totals(name, movies, ratings, state)
+                for name in names
+            )
+
+        for i, result in enumerate(results):
+            totals[i] = result
+
+        # components only ever contributed their positive scores
+        np.maximum(totals, 0, out=totals)
+
+        weights = np.array([self.weights[name] for name in names], dtype=np.float32)
+        recommendations = weights @ totals
+
+        if state is not None:
+            state.commit()
+
+        return recommendations
+
+    def run_parallel(
+        self, names: List[str], movies, ratings, state: RecommenderState = None
+    ) -> List[np.ndarray]:
+        """runs every component on the pool and waits for all of them, the job
+        takes about as long as the slowest component"""
+        if CombinedRecommender.executor is None:
+            CombinedRecommender.executor = ThreadPoolExecutor(
+                thread_name_prefix="recommender"
+            )
+
+        # the flask scoped session must not be shared between threads
+        Session = sessionmaker(bind=self.db.engine)
+        sessions = []
+
+        for name in names:
+            component = self.components[name]
+
+            if hasattr(component, "session"):
+                component.session = Session()
+                sessions.append(component.session)
 
         start = time.time()
-        content_based = self.content_based_recommender.find_most_simmilar(
-            movies, ratings
-        )
-        logger.debug(f"Content Based Recommendation took {time.time() - start}")
 
-        recommendations = defaultdict(lambda: 0)
+        try:
+            futures = [
+                self.executor.submit(
+                    self.timed_component_totals, name, movies, ratings, state
+                )
+                for name in names
+            ]
+            results = [future.result() for future in futures]
+        finally:
+            for session in sessions:
+                session.close()
 
-        for movie, score in zip(*user_based):
-            recommendations[movie] += score * self.weights["user"]
+        logger.debug(f"All components took {time.time() - start}")
+        return results
 
-        for movie, score in zip(*content_based):
-            recommendations[movie] += score * self.weights["content"]
+    def timed_component_totals(
+        self, name: str, movies, ratings, state: RecommenderState = None
+    ) -> np.ndarray:
+        start = time.time()
 
-        sorted_recommendations = sorted(
-            filter(
-                lambda x: recommendations.get(x) > 0,
-                recommendations,
-            ),
-            key=lambda x: recommendations.get(x),
-            reverse=True,
+        totals = self.component_totals(
+            name, self.components[name], movies, ratings, state
         )
 
-        scores = [recommendations[i] for i in sorted_recommendations]
-        return sorted_recommendations, scores
+        logger.debug(
+            f"{name.capitalize()} Based Recommendation took {time.time() - start}"
+        )
+        return totals
+
+    @staticmethod
+    def component_totals(
+        name, component, movies, ratings, state: RecommenderState = None
+    ) -> np.ndarray:
+        """the unranked scores of a component over the catalog positions"""
+        if state is None or not component.linear:
+            return component.get_total_scores(movies, ratings)
+
+        return state.component_totals(name, component, movies, ratings)
@@ -1,5 +1,6 @@
 from typing import List, Tuple, Dict, Set
 from movie_recommender.querying.sql_models import (
+    db,
     Movie,
     Actor,
     Director,
@@ -9,6 +10,10 @@ from movie_recommender.querying.sql_models import (
 from collections import defaultdict
 from loguru import logger
 from movie_recommender.querying.chroma import CHROMA_Manager
+from movie_recommender.indexes import CreditIndex, MovieCatalog, PlotNeighbourTable
+from .dense import rank_dense_scores
+from scipy import sparse
+import numpy as np
 
 
 class ContentBasedRecommender:
@@ -18,13 +23,59 @@ class ContentBasedRecommender:
         "plots": 1.2,
     }
 
+    # get_total_scores is linear in the ratings
+    linear = True
+
+    def __init__(
+        self,
+        catalog: MovieCatalog,
+        credit_index: CreditIndex = None,
+        sparse_scoring: bool = True,
+        plot_neighbours: PlotNeighbourTable = None,
+        session=None,
+        weights: dict = None,
+    ) -> None:
+        self.catalog = catalog
+        # per instance, jobs of different model snapshots run side by side
+        if weights is not None:
+            self.weights = weights
+        # the sql fallbacks query with this session, the flask one by default
+        self.session = session if session is not None else db.session
+
+        if credit_index is not None and not catalog.matches(credit_index.movie_ids):
+            logger.warning("The credit index is stale, reading credits with sql")
+            credit_index = None
+
+        # with a credit index actors and directors are read without sql
+        self.credit_index = credit_index
+        # precomputed plot neighbours, chroma is only asked for the rest
+        self.plot_neighbours = plot_neighbours
+        # scores everything with sparse products over the credit index, gives
+        # the same scores as the loops in get_scores
+        self.sparse_scoring = sparse_scoring and credit_index is not None
+        # get_batch_total_scores needs the sparse products
+        self.batch_scoring = self.sparse_scoring
+
     def find_most_simmilar(
-        self, movies: List[Movie], ratings: List[float]
-    ) -> Tuple[List[Movie], List[float]]:
-        """returns list of movies and similartiy scores"""
+        self, movies: np.ndarray, ratings: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """returns catalog positions and similartiy scores, movies are the
+        catalog positions of the rated movies"""
+
+        total_scores = self.get_total_scores(movies, ratings)
+
+        return self.rank_total_scores(total_scores, movies, top_n)
+
+    def get_total_scores(self, movies: np.ndarray, ratings: np.ndarray) -> np.ndarray:
+        """weighted sum of all signals over the catalog positions, the inputs
+        are not removed. Every signal is linear in the ratings, so scores of a
+        rating change can be added to the old total."""
 
         assert len(movies) == len(ratings)
 
+        if self.sparse_scoring:
+            return self.get_dense_total_scores(movies, ratings)
+
         import time
 
         start_time = time.time()
@@ -33,46 +84,158 @@ class ContentBasedRecommender:
 
         logger.info(f"the scores {time.time()- start_time}")
 
-        total_scores: Dict[Movie, float] = defaultdict(lambda: 0)
+        total_scores = np.zeros(len(self.catalog), dtype=np.float32)
 
-        for movie, val in actor_scores.items():
-            total_scores[movie] += val * self.weights["actors"]
+        for scores, weight in (
+            (actor_scores, self.weights["actors"]),
+            (director_scores, self.weights["directors"]),
+            (plot_scores, self.weights["plots"]),
+        ):
+            positions = self.catalog.positions(scores.keys())
+            values = np.fromiter(scores.values(), dtype=np.float32, count=len(scores))
 
-        for movie, val in director_scores.items():
-            total_scores[movie] += val * self.weights["directors"]
+            known = positions >= 0
+            np.add.at(total_scores, positions[known], values[known] * weight)
 
-        for movie, val in plot_scores.items():
-            total_scores[movie] += val * self.weights["plots"]
+        return total_scores
 
-        # delete the inputs
-        for movie in movies:
-            if movie in total_scores:
-                del total_scores[movie]
+    def get_dense_total_scores(
+        self, movies: np.ndarray, ratings: np.ndarray
+    ) -> np.ndarray:
+        """float32 scores over the catalog positions, which are the credit
+        index positions"""
+        import time
 
-        sorted_movies = list(
-            filter(
-                lambda key: total_scores[key] > 0,
-                sorted(total_scores.keys(), key=total_scores.get, reverse=True),
-            )
-        )
+        index = self.credit_index
+        rating_vector = index.rating_vector(self.catalog.movie_ids[movies], ratings)
+
+        start = time.time()
+
+        total_scores = self.weights["actors"] * index.actor_scores(rating_vector)
+        total_scores += self.weights["directors"] * index.director_scores(rating_vector)
+
+        logger.info(f"credits {time.time()- start}")
+        start = time.time()
+
+        plot_scores = np.zeros(index.n_movies, dtype=np.float32)
+
+        similar_plots = self.get_similar_plots_batch(self.catalog.movie_ids[movies])
+
+        for rating, similarities in zip(ratings, similar_plots):
+            for other_id, similarity in similarities.items():
+                position = index.position(other_id)
+                if position is not None:
+                    plot_scores[position] += similarity * rating
+
+        logger.info(f"plots {time.time()- start}")
+
+        total_scores += self.weights["plots"] * plot_scores
+        return total_scores.astype(np.float32)
+
+    def get_batch_total_scores(self, ratings: sparse.csr_matrix) -> np.ndarray:
+        """get_dense_total_scores for every row of a users x catalog rating
+        matrix, as sparse matrix products"""
+        index = self.credit_index
+        dense_ratings = ratings.toarray()
+
+        actors = (ratings @ index.actor_matrix) @ index.actor_matrix.T
+        actors = actors.toarray() - index.actor_counts * dense_ratings
+
+        directors = (ratings @ index.first_director_matrix) @ index.director_matrix.T
+        directors = directors.toarray() - index.has_director * dense_ratings
+
+        plots = (ratings @ self.plot_matrix(np.unique(ratings.indices))).toarray()
+
+        total_scores = self.weights["actors"] * actors
+        total_scores += self.weights["directors"] * directors
+        total_scores += self.weights["plots"] * plots
+        return total_scores.astype(np.float32)
+
+    def plot_matrix(self, movies: np.ndarray) -> sparse.csr_matrix:
+        """catalog x catalog plot similarities, filled for the rows of movies"""
+        similar_plots = self.get_similar_plots_batch(self.catalog.movie_ids[movies])
+
+        rows, columns, values = [], [], []
+
+        for movie, similarities in zip(movies, similar_plots):
+            positions = self.catalog.positions(similarities.keys())
+            known = positions >= 0
+
+            rows.append(np.full(known.sum(), movie, dtype=np.int32))
+            columns.append(positions[known])
+            values.append(np.fromiter(similarities.values(), np.float32)[known])
+
+        shape = (len(self.catalog), len(self.catalog))
+
+        if not rows:
+            return sparse.csr_matrix(shape, dtype=np.float32)
 
-        scores = [total_scores[movie] for movie in sorted_movies]
+        return sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+            shape=shape,
+        )
 
-        return sorted_movies, scores
+    def rank_total_scores(
+        self, total_scores: np.ndarray, movies: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """deletes the inputs and sorts the positive scores"""
+        return rank_dense_scores(total_scores, movies, top_n)
 
     def get_scores(
-        self, movies: List[Movie], ratings: List[float]
+        self, movies: np.ndarray, ratings: np.ndarray
     ) -> Tuple[Dict, Dict, Dict]:
-        """Given a list of movie we find the movies which are most similar to them"""
+        """Given the catalog positions of movies we find the movies which are
+        most similar to them, all scores are keyed by movie id"""
+
+        import time
+
+        if self.credit_index is not None:
+            start = time.time()
+            actor_scores, director_scores = self.get_credit_scores_from_index(
+                movies, ratings
+            )
+            logger.info(f"credits {time.time()- start}")
+        else:
+            actor_scores, director_scores = self.get_credit_scores(movies, ratings)
+
+        plot_scores: Dict[int, float] = defaultdict(lambda: 0)
+
+        start = time.time()
+
+        similar_plots = self.get_similar_plots_batch(self.catalog.movie_ids[movies])
+
+        for rating, similarities in zip(ratings, similar_plots):
+            for other_id, similarity in similarities.items():
+                plot_scores[other_id] += similarity * rating
+
+        logger.info(f"plots {time.time()- start}")
+
+        return actor_scores, director_scores, plot_scores
+
+    def get_credit_scores(
+        self, movies: np.ndarray, ratings: np.ndarray
+    ) -> Tuple[Dict, Dict]:
+        """actor and director scores by movie id, queried with sql"""
+        movie_ids = [int(i) for i in self.catalog.movie_ids[movies]]
+        by_id = {
+            movie.id: movie
+            for movie in self.session.query(Movie).filter(Movie.id.in_(movie_ids))
+        }
+
+        rated = [
+            (by_id[movie_id], rating)
+            for movie_id, rating in zip(movie_ids, ratings)
+            if movie_id in by_id
+        ]
 
         # first the directors
-        director_scores: Dict[Movie, int] = defaultdict(lambda: 0)
+        director_scores: Dict[int, int] = defaultdict(lambda: 0)
 
         import time
 
         start = time.time()
 
-        for movie, rating in zip(movies, ratings):
+        for movie, rating in rated:
             director = self.get_director(movie)
 
             if director is None:
@@ -83,14 +246,14 @@ class ContentBasedRecommender:
                 if other_movie.id == movie.id:
                     continue
 
-                director_scores[other_movie] += rating
+                director_scores[other_movie.id] += rating
 
         logger.info(f"direcor {time.time()- start}")
         start = time.time()
 
-        actor_scores: Dict[Movie, int] = defaultdict(lambda: 0)
+        actor_scores: Dict[int, int] = defaultdict(lambda: 0)
 
-        for movie, rating in zip(movies, ratings):
+        for movie, rating in rated:
             actors = self.get_actors(movie)
 
             for actor in actors:
@@ -98,62 +261,101 @@ class ContentBasedRecommender:
                     if other_movie.id == movie.id:
                         continue
 
-                    actor_scores[other_movie] += rating
-
-        plot_scores: Dict[Movie, float] = defaultdict(lambda: 0)
+                    actor_scores[other_movie.id] += rating
 
         logger.info(f"actors {time.time()- start}")
-        start = time.time()
 
-        for movie, rating in zip(movies, ratings):
-            for other_movie, distance in zip(
-                *self.get_movies_with_similar_plots(movie)
-            ):
-                plot_scores[other_movie] += distance * rating
+        return actor_scores, director_scores
 
-        logger.info(f"plots {time.time()- start}")
+    def get_credit_scores_from_index(
+        self, movies: np.ndarray, ratings: np.ndarray
+    ) -> Tuple[Dict, Dict]:
+        """same as get_credit_scores but read from the credit index"""
+        index = self.credit_index
 
-        return actor_scores, director_scores, plot_scores
+        director_scores: Dict[int, int] = defaultdict(lambda: 0)
+        actor_scores: Dict[int, int] = defaultdict(lambda: 0)
+
+        # the credit index shares the catalog positions
+        for position, rating in zip(movies, ratings):
+            director = index.director_of(position)
+
+            if director is None:
+                logger.info(f"Cant find director for {self.catalog.titles[position]}")
+            else:
+                for other in index.movies_of_director(director):
+                    if other != position:
+                        director_scores[int(index.movie_ids[other])] += rating
+
+            for actor in index.actors_of(position):
+                for other in index.movies_of_actor(actor):
+                    if other != position:
+                        actor_scores[int(index.movie_ids[other])] += rating
+
+        return actor_scores, director_scores
 
-    @staticmethod
-    def get_actors(movie: Movie) -> List[Actor]:
+    def get_actors(self, movie: Movie) -> List[Actor]:
         return (
-            Actor.query.join(movie_actors, Actor.id == movie_actors.c.actor_id)
+            self.session.query(Actor)
+            .join(movie_actors, Actor.id == movie_actors.c.actor_id)
             .filter(movie_actors.c.movie_id == movie.id)
             .all()
         )
 
-    @staticmethod
-    def get_movies_of_actor(actor: Actor) -> List[Movie]:
+    def get_movies_of_actor(self, actor: Actor) -> List[Movie]:
         return (
-            Movie.query.join(movie_actors, Movie.id == movie_actors.c.movie_id)
+            self.session.query(Movie)
+            .join(movie_actors, Movie.id == movie_actors.c.movie_id)
             .filter(movie_actors.c.actor_id == actor.id)
             .all()
         )
 
-    @staticmethod
-    def get_director(movie: Movie) -> List[Director]:
+    def get_director(self, movie: Movie) -> List[Director]:
         return (
-            Director.query.join(
-                movie_directors, Director.id == movie_directors.c.director_id
-            )
+            self.session.query(Director)
+            .join(movie_directors, Director.id == movie_directors.c.director_id)
             .filter(movie_directors.c.movie_id == movie.id)
+            # the same director as CreditIndex.director_of
+            .order_by(Director.id)
             .first()
         )
 
-    @staticmethod
-    def get_movies_of_director(director: Director) -> List[Movie]:
+    def get_movies_of_director(self, director: Director) -> List[Movie]:
         return (
-            Movie.query.join(movie_directors, Movie.id == movie_directors.c.movie_id)
+            self.session.query(Movie)
+            .join(movie_directors, Movie.id == movie_directors.c.movie_id)
             .filter(movie_directors.c.director_id == director.id)
             .all()
         )
 
-    @staticmethod
     def get_movies_with_similar_plots(
-        movie: Movie, n_results=10
+        self, movie: Movie, n_results=10
     ) -> Tuple[List[Movie], List[float]]:
         manager = CHROMA_Manager.get_instance()
         movie_ids, distances = manager.query(movie.id, n_results)
-        movies = Movie.query.filter(Movie.id.in_(movie_ids)).all()
+        movies = self.session.query(Movie).filter(Movie.id.in_(movie_ids)).all()
         return movies, distances
+
+    def get_similar_plots_batch(
+        self, movie_ids: List[int], n_results=10
+    ) -> List[Dict[int, float]]:
+        """similar movie id -> similarity for all movies with one chroma get and
+        one chroma query. Movies in the plot neighbour table are not sent to
+        chroma."""
+        movie_ids = [int(i) for i in movie_ids]
+
+        if self.plot_neighbours is not None and n_results <= self.plot_neighbours.k:
+            similar = self.plot_neighbours.query_many(movie_ids, n_results)
+        else:
+            similar = [None] * len(movie_ids)
+
+        missing = [i for i, similarities in enumerate(similar) if similarities is None]
+
+        if missing:
+            manager = CHROMA_Manager.get_instance()
+            queried = manager.query_many([movie_ids[i] for i in missing], n_results)
+
+            for i, similarities in zip(missing, queried):
+                similar[i] = similarities
+
+        return similar
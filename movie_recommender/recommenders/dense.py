@@ -0,0 +1,74 @@
+from movie_recommender import MIN_SCORE, MAX_RECOMENDATIOSN, RECOMMENDATION_HEADROOM
+from movie_recommender.indexes import MovieCatalog
+from typing import Tuple
+import numpy as np
+
+
+def rank_dense_scores(
+    totals: np.ndarray, exclude: np.ndarray, top_n: int = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """catalog positions with positive scores sorted by score and their
+    scores, the excluded positions (the inputs) are dropped. With top_n only
+    the best top_n are partitioned out and sorted, without it everything."""
+    totals = np.asarray(totals, dtype=np.float32)
+
+    positive = totals > 0
+    positive[exclude] = False
+
+    positions = np.flatnonzero(positive)
+
+    if top_n is not None and top_n < len(positions):
+        # argpartition picks any of the scores tied with the top_n-th one,
+        # all of them are kept so the lexsort below decides like the full
+        # ranking
+        scores = totals[positions]
+        kth = -np.partition(-scores, top_n - 1)[top_n - 1]
+        positions = positions[scores >= kth]
+
+    # by score, ties in catalog order
+    positions = positions[np.lexsort((positions, -totals[positions]))][:top_n]
+
+    return positions.astype(np.int32), totals[positions]
+
+
+def genre_top_lists(
+    totals: np.ndarray, exclude: np.ndarray, catalog: MovieCatalog, top_n: int
+) -> np.ndarray:
+    """union of the best top_n positions of every single genre"""
+    best = [
+        rank_dense_scores(
+            np.where(catalog.with_genres(catalog.genre_mask([genre])), totals, 0),
+            exclude,
+            top_n,
+        )[0]
+        for genre in catalog.genres
+    ]
+    if not best:
+        return np.zeros(0, dtype=np.int32)
+
+    return np.unique(np.concatenate(best)).astype(np.int32)
+
+
+def stored_recommendations(
+    totals: np.ndarray, exclude: np.ndarray, catalog: MovieCatalog
+) -> np.ndarray:
+    """positions a job stores for the recommendations page sorted by score,
+    the overall top list and a full page for every single genre"""
+    positions, _ = rank_dense_scores(
+        totals, exclude, MAX_RECOMENDATIOSN * RECOMMENDATION_HEADROOM
+    )
+    positions = np.union1d(
+        positions, genre_top_lists(totals, exclude, catalog, MAX_RECOMENDATIOSN)
+    )
+
+    # the page never shows scores below MIN_SCORE
+    positions = positions[totals[positions] >= MIN_SCORE]
+    return positions[np.argsort(-totals[positions], kind="stable")].astype(np.int32)
+
+
+def score_blob(totals: np.ndarray, exclude: np.ndarray) -> bytes:
+    """the positive scores of every catalog position without the inputs, as
+    stored in UserScores"""
+    totals = np.maximum(totals, 0).astype(np.float32)
+    totals[exclude] = 0
+    return totals.tobytes()
@@ -0,0 +1,55 @@
+from movie_recommender.indexes import FactorModel, MovieCatalog
+from movie_recommender.utils import normalize_score
+from .dense import rank_dense_scores
+from scipy import sparse
+from typing import Tuple
+import numpy as np
+
+
+def training_scale(ratings: np.ndarray) -> np.ndarray:
+    """the jobs pass (rating - 3) ** 3, the factors were trained on the
+    normalize_score of the RatingMatrix"""
+    return normalize_score(np.cbrt(np.asarray(ratings, dtype=np.float64)) + 3)
+
+
+class FactorRecommender:
+    """Folds the user into the latent factor model and scores every movie
+    with one matrix-vector product."""
+
+    # the fold in is a least squares solve, not linear in the ratings
+    linear = False
+    # get_batch_total_scores folds many users in at once
+    batch_scoring = True
+
+    def __init__(self, catalog: MovieCatalog, factor_model: FactorModel) -> None:
+        self.catalog = catalog
+        self.factor_model = factor_model
+
+    def find_most_simmilar(
+        self, movies: np.ndarray, ratings: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        totals = self.get_total_scores(movies, ratings)
+
+        return rank_dense_scores(totals, movies, top_n)
+
+    def get_total_scores(self, movies: np.ndarray, ratings: np.ndarray) -> np.ndarray:
+        """predicted ratings over the catalog positions"""
+        model = self.factor_model
+
+        totals = model.score(self.catalog.movie_ids[movies], training_scale(ratings))
+
+        return self.catalog.scatter(model.movie_ids, totals)
+
+    def get_batch_total_scores(self, ratings: sparse.csr_matrix) -> np.ndarray:
+        """get_total_scores for every row of a users x catalog rating matrix"""
+        model = self.factor_model
+
+        # before the projection, a 3 star rating is 0 until it is rescaled
+        ratings = sparse.csr_matrix(ratings, dtype=np.float32, copy=True)
+        ratings.data = training_scale(ratings.data).astype(np.float32)
+
+        if not self.catalog.matches(model.movie_ids):
+            ratings = ratings @ self.catalog.projection(model.movie_ids)
+
+        totals = model.score_many(sparse.csr_matrix(ratings))
+        return self.catalog.scatter(model.movie_ids, totals)
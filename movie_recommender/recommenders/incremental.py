@@ -0,0 +1,76 @@
+from typing import Dict
+from loguru import logger
+import numpy as np
+
+
+class RecommenderState:
+    """What the last job of a user was computed from.
+
+    Components marked linear score linearly in the ratings, so the next
+    job only scores the added, removed and changed ratings and adds that to
+    the stored totals. Everything else (the neighbour search) is recomputed.
+    """
+
+    # full recompute after so many incremental jobs, keeps rounding errors small
+    max_updates = 20
+
+    def __init__(self, model_version: str = None) -> None:
+        # totals of another model or catalog can not be reused
+        self.model_version = model_version
+        self.ratings: Dict[int, float] = {}
+        self.totals: Dict[str, object] = {}
+        self.updates = 0
+
+        self._current: Dict[int, float] = {}
+        self._pending: Dict[str, object] = {}
+        self._full = True
+        self._delta_movies = np.zeros(0, dtype=np.int32)
+        self._delta_ratings = np.zeros(0, dtype=np.float32)
+
+    def begin(self, movies: np.ndarray, ratings: np.ndarray) -> None:
+        """diffs the ratings of this job against the last one, movies are
+        catalog positions"""
+        self._current = {
+            int(movie): float(rating) for movie, rating in zip(movies, ratings)
+        }
+        self._pending = {}
+        self._full = not self.ratings or self.updates >= self.max_updates
+
+        if self._full:
+            return
+
+        deltas = {
+            movie: self._current.get(movie, 0) - self.ratings.get(movie, 0)
+            for movie in self._current.keys() | self.ratings.keys()
+        }
+        deltas = {movie: delta for movie, delta in deltas.items() if delta != 0}
+
+        # removed movies are plain positions too, nothing is loaded
+        self._delta_movies = np.fromiter(
+            deltas.keys(), dtype=np.int32, count=len(deltas)
+        )
+        self._delta_ratings = np.fromiter(
+            deltas.values(), dtype=np.float32, count=len(deltas)
+        )
+
+        logger.debug(f"Incremental update with {len(self._delta_movies)} changes")
+
+    def component_totals(self, name: str, component, movies, ratings):
+        if self._full or name not in self.totals:
+            totals = component.get_total_scores(movies, ratings)
+        elif len(self._delta_movies):
+            # a new array, the stored totals stay until commit
+            totals = self.totals[name] + component.get_total_scores(
+                self._delta_movies, self._delta_ratings
+            )
+        else:
+            totals = self.totals[name]
+
+        self._pending[name] = totals
+        return totals
+
+    def commit(self) -> None:
+        """called once the job went through, until then the old state stays"""
+        self.updates = 0 if self._full else self.updates + 1
+        self.totals = self._pending
+        self.ratings = self._current
@@ -0,0 +1,55 @@
+from movie_recommender.indexes import ItemSimilarityTable, MovieCatalog
+from .dense import rank_dense_scores
+from scipy import sparse
+from typing import Tuple
+import numpy as np
+
+
+class ItemBasedRecommender:
+    """Scores movies by the precomputed similarities to the rated movies,
+    no users are searched at request time."""
+
+    # get_total_scores is linear in the ratings
+    linear = True
+    # get_batch_total_scores scores many users with one sparse product
+    batch_scoring = True
+
+    def __init__(
+        self, catalog: MovieCatalog, item_similarity: ItemSimilarityTable
+    ) -> None:
+        self.catalog = catalog
+        self.item_similarity = item_similarity
+        self._matrix = None
+
+    def find_most_simmilar(
+        self, movies: np.ndarray, ratings: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        totals = self.get_total_scores(movies, ratings)
+
+        return self.rank_total_scores(totals, movies, top_n)
+
+    def get_total_scores(self, movies: np.ndarray, ratings: np.ndarray) -> np.ndarray:
+        """linear in the ratings like ContentBasedRecommender.get_total_scores"""
+        table = self.item_similarity
+        totals = table.score(self.catalog.movie_ids[movies], ratings)
+
+        # the table keeps the movie axis it was built with
+        return self.catalog.scatter(table.movie_ids, totals)
+
+    def get_batch_total_scores(self, ratings: sparse.csr_matrix) -> np.ndarray:
+        """get_total_scores for every row of a users x catalog rating matrix"""
+        table = self.item_similarity
+
+        if self._matrix is None:
+            self._matrix = table.matrix()
+
+        if not self.catalog.matches(table.movie_ids):
+            ratings = ratings @ self.catalog.projection(table.movie_ids)
+
+        totals = (ratings @ self._matrix).toarray()
+        return self.catalog.scatter(table.movie_ids, totals)
+
+    def rank_total_scores(
+        self, totals: np.ndarray, movies: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return rank_dense_scores(totals, movies, top_n)
@@ -1,8 +1,10 @@
-from movie_recommender.querying.sql_models import Movie, Rating, OldUser
+from movie_recommender.querying.sql_models import Rating
 import numpy as np
-from collections import defaultdict
-from movie_recommender.utils import normalize_score, l2
+from movie_recommender.utils import normalize_score, l2, as_batched, BatchedMetric
+from movie_recommender.indexes import MovieCatalog, RatingMatrix, UserANNIndex
+from .dense import rank_dense_scores
 from typing import List, Set, Tuple, Dict
+from loguru import logger
 
 
 class UserBasedRecommender:
@@ -11,100 +13,167 @@ class UserBasedRecommender:
         "closest_relevant_users": 5,
     }
 
-    def __init__(self, db, distance_metric: callable = l2) -> None:
+    # how many ann candidates are reranked with the distance metric
+    ann_candidates = 50
+
+    # the neighbours depend on the ratings, so totals can not be updated
+    linear = False
+    # every user searches their own neighbours, batches are scored row by row
+    batch_scoring = False
+
+    def __init__(
+        self,
+        db,
+        catalog: MovieCatalog,
+        distance_metric: callable = l2,
+        rating_matrix: RatingMatrix = None,
+        ann_index: UserANNIndex = None,
+        session=None,
+        weights: dict = None,
+    ) -> None:
         self.db = db
-        self.distance_metric = distance_metric
-
-    @staticmethod
-    def get_overlapping_users(movies: Movie) -> set[int]:
-        user_ids = set()
-
-        for movie in movies:
-            if movie is None:
-                continue
-
-            different_ratings = movie.ratings
-            for rating in different_ratings:
-                if rating.old_user_id is not None:
-                    user_ids.add(rating.old_user_id)
-
-        return user_ids
-
-    def get_embedding(self, user_id, sorted_movies_keys: dict[str]):
-        # get user
-        user = self.db.session.get(OldUser, user_id)
-        rated_movies = {
-            i.id: i.value
-            for i in user.ratings
-            if i is not None and i in sorted_movies_keys
-        }
-        return np.array(
+        # per instance, jobs of different model snapshots run side by side
+        if weights is not None:
+            self.weights = weights
+        # the sql fallback queries with this session, the flask one by default
+        self.session = session if session is not None else db.session
+        self.catalog = catalog
+        # names, BatchedMetrics and old per pair callables are all accepted
+        self.distance_metric: BatchedMetric = as_batched(distance_metric)
+
+        if rating_matrix is not None and not catalog.matches(rating_matrix.movie_ids):
+            logger.warning("The rating matrix is stale, searching neighbours with sql")
+            rating_matrix = None
+
+        # with a rating matrix the neighbours are found without sql
+        self.rating_matrix = rating_matrix
+
+        if ann_index is not None and (
+            rating_matrix is None or not ann_index.matches(rating_matrix)
+        ):
+            logger.warning("The user ann index is stale, run 'flask buildannindex'")
+            ann_index = None
+
+        # with an ann index the neighbours are not limited to overlapping users
+        self.ann_index = ann_index
+
+    def get_overlapping_users(self, movie_ids: List[int]) -> Set[int]:
+        rows = (
+            self.session.query(Rating.old_user_id)
+            .filter(Rating.movie_id.in_(movie_ids), Rating.old_user_id.isnot(None))
+            .distinct()
+        )
+        return {row[0] for row in rows}
+
+    def get_embedding(
+        self, user_id, sorted_movie_ids: List[int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """normalized ratings padded with the default value and the mask of the
+        movies the user really rated, like RatingMatrix.neighbour_vectors"""
+        rated_movies = dict(
+            self.session.query(Rating.movie_id, Rating.value).filter(
+                Rating.old_user_id == user_id, Rating.movie_id.in_(sorted_movie_ids)
+            )
+        )
+        embedding = np.array(
             [
-                normalize_score(rated_movies.get(i.id, self.weights["default_vec_val"]))
-                for i in sorted_movies_keys
+                normalize_score(rated_movies.get(i, self.weights["default_vec_val"]))
+                for i in sorted_movie_ids
             ]
         )
+        return embedding, np.array([i in rated_movies for i in sorted_movie_ids])
 
     def find_most_simmilar(
-        self, movies: List[Movie], ratings: List[float]
-    ) -> Tuple[List[Movie], List[float]]:
-        user_ratings = dict(zip(movies, ratings))
+        self, movies: np.ndarray, ratings: np.ndarray, top_n: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """movies are catalog positions, returns catalog positions and scores"""
+        recommendations = self.get_total_scores(movies, ratings)
 
-        sorted_movie_keys = dict.fromkeys(
-            sorted(user_ratings.keys(), key=lambda x: x.id)
-        )
+        return rank_dense_scores(recommendations, movies, top_n)
 
-        recommendations = self.get_recommendations(
-            movies, user_ratings, sorted_movie_keys
-        )
+    def get_total_scores(self, movies: np.ndarray, ratings: np.ndarray) -> np.ndarray:
+        # positions are sorted like the movie ids
+        order = np.argsort(movies)
+        movies, ratings = movies[order], np.asarray(ratings)[order]
 
-        sorted_recommendations = sorted(
-            filter(
-                lambda x: recommendations.get(x) > 0 and x not in user_ratings,
-                recommendations,
-            ),
-            key=lambda x: recommendations.get(x),
-            reverse=True,
-        )
+        return self.get_recommendations(movies, ratings)
 
-        recommended_movies = sorted_recommendations
-        scores = [recommendations[i] for i in sorted_recommendations]
+    def get_recommendations(
+        self, movies: np.ndarray, ratings: np.ndarray
+    ) -> np.ndarray:
+        """summed normalized ratings of the closest users over the catalog"""
+        if self.rating_matrix is not None:
+            return self.get_recommendations_from_matrix(movies, ratings)
 
-        return recommended_movies, scores
+        recommendations = np.zeros(len(self.catalog), dtype=np.float32)
 
-    def get_recommendations(self, movies, user_ratings, sorted_movie_keys):
-        user_array = np.array(
-            [normalize_score(user_ratings[key]) for key in sorted_movie_keys]
-        )
+        user_array = normalize_score(np.asarray(ratings, dtype=np.float64))
+        movie_ids = [int(i) for i in self.catalog.movie_ids[movies]]
 
-        overlapping_users = self.get_overlapping_users(movies)
+        overlapping_users = self.get_overlapping_users(movie_ids)
 
-        user_ids, vectors = [], []
+        user_ids, vectors, masks = [], [], []
 
         for user_id in overlapping_users:
             user_ids.append(user_id)
 
-            embedding = self.get_embedding(user_id, sorted_movie_keys)
+            embedding, rated = self.get_embedding(user_id, movie_ids)
             vectors.append(embedding)
+            masks.append(rated)
+
+        if not user_ids:
+            return recommendations
 
         user_ids, vectors = np.array(user_ids), np.array(vectors)
+        # from the ratings, a real rating can equal the padding
+        mask = np.array(masks, dtype=bool)
 
-        distances = np.array([self.distance_metric(vec, user_array) for vec in vectors])
+        distances = self.distance_metric(user_array, vectors, mask)
 
         best = np.argsort(distances)
 
-        recommendations = defaultdict(lambda: 0)
-
         relevant_users = user_ids[best[: self.weights["closest_relevant_users"]]]
 
-        for user_id in relevant_users:
-            user = self.db.session.get(OldUser, int(user_id))
+        rows = (
+            self.session.query(Rating.movie_id, Rating.value)
+            .filter(Rating.old_user_id.in_([int(i) for i in relevant_users]))
+            .all()
+        )
 
-            if user is None:
-                continue
+        positions, values = self.catalog.rated(
+            [row[0] for row in rows], [row[1] for row in rows]
+        )
+        np.add.at(recommendations, positions, normalize_score(values))
 
-            for rating in user.ratings:
-                if rating.movie is None:
-                    continue
-                recommendations[rating.movie] += normalize_score(rating.value)
         return recommendations
+
+    def get_recommendations_from_matrix(
+        self, movies: np.ndarray, ratings: np.ndarray
+    ) -> np.ndarray:
+        matrix = self.rating_matrix
+
+        # the rating matrix shares the catalog positions
+        columns = movies
+        user_array = normalize_score(np.asarray(ratings, dtype=np.float64))
+
+        if self.ann_index is not None:
+            n_candidates = max(
+                self.ann_candidates, self.weights["closest_relevant_users"]
+            )
+            rows = self.ann_index.query(columns, user_array, n_candidates)
+        else:
+            rows = matrix.overlapping_users(columns)
+
+        if len(rows) == 0:
+            return np.zeros(len(self.catalog), dtype=np.float32)
+
+        vectors, mask = matrix.neighbour_vectors(
+            rows, columns, self.weights["default_vec_val"]
+        )
+
+        distances = self.distance_metric(user_array, vectors, mask)
+
+        best = np.argsort(distances)
+        relevant_rows = rows[best[: self.weights["closest_relevant_users"]]]
+
+        return matrix.summed_ratings(relevant_rows).astype(np.float32)
@@ -7,3 +7,84 @@ def normalize_score(val: float):
 
 def l2(a, b):
     return np.sqrt(np.square(a - b).sum())
+
+
+class BatchedMetric:
+    """Distance of one query vector to every row of a 2d block in one numpy call.
+
+    `mask` marks the entries of the block that were really rated, metrics that
+    do not care about padding ignore it.
+    """
+
+    def __init__(self, name: str, func: callable) -> None:
+        self.name = name
+        self.func = func
+
+    def __call__(self, query: np.ndarray, block: np.ndarray, mask=None) -> np.ndarray:
+        return self.func(np.asarray(query), np.atleast_2d(block), mask)
+
+    def __repr__(self) -> str:
+        return f"BatchedMetric({self.name})"
+
+
+def _l2(query, block, mask):
+    return np.sqrt(np.square(block - query).sum(axis=1))
+
+
+def _cosine(query, block, mask):
+    norms = np.linalg.norm(block, axis=1) * np.linalg.norm(query)
+    dots = block @ query
+
+    similarity = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+    return 1 - similarity
+
+
+def _pearson(query, block, mask):
+    return _cosine(
+        query - query.mean(), block - block.mean(axis=1, keepdims=True), mask
+    )
+
+
+def _overlap(query, block, mask):
+    """root mean squared difference over the movies both rated"""
+    if mask is None:
+        mask = np.ones(block.shape, dtype=bool)
+
+    counts = mask.sum(axis=1)
+    squared = np.where(mask, np.square(block - query), 0).sum(axis=1)
+
+    distances = np.full(len(block), np.inf)
+    np.sqrt(squared / np.maximum(counts, 1), out=distances, where=counts > 0)
+    return distances
+
+
+batched_l2 = BatchedMetric("l2", _l2)
+batched_cosine = BatchedMetric("cosine", _cosine)
+batched_pearson = BatchedMetric("pearson", _pearson)
+batched_overlap = BatchedMetric("overlap", _overlap)
+
+DISTANCE_METRICS = {
+    metric.name: metric
+    for metric in [batched_l2, batched_cosine, batched_pearson, batched_overlap]
+}
+
+
+def as_batched(metric) -> BatchedMetric:
+    """accepts a metric name, a BatchedMetric or an old per pair callable"""
+    if isinstance(metric, BatchedMetric):
+        return metric
+
+    if isinstance(metric, str):
+        if metric not in DISTANCE_METRICS:
+            raise ValueError(
+                f"Unknown distance metric {metric}, choose from {list(DISTANCE_METRICS)}"
+            )
+        return DISTANCE_METRICS[metric]
+
+    if metric is l2:
+        return batched_l2
+
+    def per_pair(query, block, mask):
+        return np.array([metric(vec, query) for vec in block], dtype=np.float64)
+
+    return BatchedMetric(getattr(metric, "__name__", "custom"), per_pair)
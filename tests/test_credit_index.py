@@ -0,0 +1,74 @@
+from movie_recommender.indexes import CreditIndex
+import numpy as np
+import pytest
+
+# toy catalog: movie ids, (movie id, actor id) and (movie id, director id)
+MOVIE_IDS = np.array([3, 5, 8, 13, 21, 34], dtype=np.int64)
+ACTOR_EDGES = [(3, 1), (3, 2), (5, 2), (8, 1), (8, 3), (13, 3), (21, 4), (99, 1)]
+# movie 8 has two directors, 34 none
+DIRECTOR_EDGES = [(3, 10), (5, 10), (8, 12), (8, 11), (13, 11), (21, 12)]
+
+
+@pytest.fixture
+def index():
+    return CreditIndex(
+        MOVIE_IDS,
+        CreditIndex._columns(ACTOR_EDGES),
+        CreditIndex._columns(DIRECTOR_EDGES),
+    )
+
+
+@pytest.fixture
+def ratings():
+    return np.array([1.5, 0, -2, 0, 0.5, 3], dtype=np.float32)
+
+
+def loop_scores(index, ratings):
+    """the per movie loops of ContentBasedRecommender.get_credit_scores"""
+    actor_scores = np.zeros(index.n_movies)
+    director_scores = np.zeros(index.n_movies)
+
+    for position in np.flatnonzero(ratings):
+        rating = ratings[position]
+
+        director = index.director_of(position)
+        if director is not None:
+            for other in index.movies_of_director(director):
+                if other != position:
+                    director_scores[other] += rating
+
+        for actor in index.actors_of(position):
+            for other in index.movies_of_actor(actor):
+                if other != position:
+                    actor_scores[other] += rating
+
+    return actor_scores, director_scores
+
+
+def test_sparse_scores_match_the_loops(index, ratings):
+    actor_scores, director_scores = loop_scores(index, ratings)
+
+    np.testing.assert_allclose(index.actor_scores(ratings), actor_scores)
+    np.testing.assert_allclose(index.director_scores(ratings), director_scores)
+
+
+def test_first_director_has_the_lowest_id(index):
+    position = index.position(8)
+    assert index.directors.person_ids[index.director_of(position)] == 11
+    assert index.director_of(index.position(34)) is None
+
+
+def test_unknown_movies_are_dropped(index):
+    assert index.position(99) is None
+    assert index.actor_matrix.shape == (len(MOVIE_IDS), 4)
+
+
+def test_from_arrays_scores_the_same(index, ratings):
+    loaded = CreditIndex.from_arrays(index.arrays())
+
+    np.testing.assert_allclose(
+        loaded.actor_scores(ratings), index.actor_scores(ratings)
+    )
+    np.testing.assert_allclose(
+        loaded.director_scores(ratings), index.director_scores(ratings)
+    )
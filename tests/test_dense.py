@@ -0,0 +1,33 @@
+from movie_recommender.recommenders.dense import rank_dense_scores
+import numpy as np
+import pytest
+
+
+def full_ranking(totals, exclude):
+    """every positive position sorted by score, ties in catalog order"""
+    positions = [
+        position
+        for position in np.argsort(-totals, kind="stable")
+        if totals[position] > 0 and position not in exclude
+    ]
+    return np.array(positions, dtype=np.int32)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("top_n", [1, 3, 10, None])
+def test_top_n_is_a_prefix_of_the_full_ranking(seed, top_n):
+    rng = np.random.default_rng(seed)
+    # few distinct values, so there are many ties
+    totals = rng.integers(-2, 4, 50).astype(np.float32)
+    exclude = rng.choice(50, 5, replace=False)
+
+    positions, scores = rank_dense_scores(totals, exclude, top_n)
+    expected = full_ranking(totals, exclude)[:top_n]
+
+    np.testing.assert_array_equal(positions, expected)
+    np.testing.assert_array_equal(scores, totals[expected])
+
+
+def test_nothing_positive():
+    positions, scores = rank_dense_scores(np.zeros(4), np.array([], dtype=int), 2)
+    assert len(positions) == 0 and len(scores) == 0
@@ -0,0 +1,51 @@
+from movie_recommender.utils import DISTANCE_METRICS, as_batched, l2
+from scipy.spatial import distance
+import numpy as np
+import pytest
+
+
+def overlap(a, b, mask):
+    if not mask.any():
+        return np.inf
+    return np.sqrt(np.mean(np.square(a[mask] - b[mask])))
+
+
+# the per pair metric of every batched one
+PER_PAIR = {
+    "l2": lambda a, b, mask: l2(a, b),
+    "cosine": lambda a, b, mask: distance.cosine(a, b),
+    "pearson": lambda a, b, mask: distance.correlation(a, b),
+    "overlap": overlap,
+}
+
+
+@pytest.fixture
+def block():
+    rng = np.random.default_rng(0)
+    query = rng.normal(size=8)
+    block = rng.normal(size=(6, 8))
+    mask = rng.random((6, 8)) > 0.4
+    # a row without common movies
+    mask[0] = False
+    return query, block, mask
+
+
+def test_every_metric_is_checked():
+    assert set(PER_PAIR) == set(DISTANCE_METRICS)
+
+
+@pytest.mark.parametrize("name", sorted(PER_PAIR))
+def test_batched_matches_per_pair(name, block):
+    query, block, mask = block
+    batched = DISTANCE_METRICS[name](query, block, mask)
+    expected = [PER_PAIR[name](query, row, m) for row, m in zip(block, mask)]
+
+    np.testing.assert_allclose(batched, expected)
+
+
+def test_per_pair_callables_are_wrapped(block):
+    query, block, mask = block
+    metric = as_batched(lambda a, b: np.abs(a - b).sum())
+
+    np.testing.assert_allclose(metric(query, block), np.abs(block - query).sum(axis=1))
+    assert as_batched(l2) is DISTANCE_METRICS["l2"]
@@ -0,0 +1,87 @@
+from movie_recommender.indexes import MovieCatalog
+import numpy as np
+import pytest
+
+GENRES = ("Action", "Comedy", "Drama")
+
+
+@pytest.fixture
+def catalog():
+    # Action = 1, Comedy = 2, Drama = 4
+    return MovieCatalog(
+        movie_ids=np.array([3, 5, 8, 13], dtype=np.int64),
+        titles=["a", "b", "c", "d"],
+        years=np.array([1999, 0, 2004, 2010], dtype=np.int32),
+        imdb_ids=["tt1", None, "tt3", "tt4"],
+        imdb_links=["l1", None, "l3", "l4"],
+        genres=GENRES,
+        genre_masks=np.array([1, 3, 6, 0], dtype=np.uint64),
+        tags=("dark", "funny"),
+        tag_offsets=np.array([0, 0, 2, 3, 3], dtype=np.int32),
+        tag_ids=np.array([1, 0, 0], dtype=np.int32),
+    )
+
+
+def test_positions_of_known_and_unknown_movies(catalog):
+    np.testing.assert_array_equal(catalog.positions([8, 4, 3]), [2, -1, 0])
+
+
+def test_rated_drops_unknown_movies(catalog):
+    positions, values = catalog.rated([13, 99, 5], [4.5, 1, 2])
+
+    np.testing.assert_array_equal(positions, [3, 1])
+    np.testing.assert_array_equal(values, np.array([4.5, 2], dtype=np.float32))
+    assert values.dtype == np.float32
+
+
+def test_scatter_by_position(catalog):
+    # an index over other movies, 99 is not in the catalog
+    scores = np.array([[1, 2, 3], [4, 5, 6]], dtype=np.float32)
+    dense = catalog.scatter(np.array([8, 99, 3]), scores)
+
+    np.testing.assert_array_equal(dense, [[3, 0, 1, 0], [6, 0, 4, 0]])
+    np.testing.assert_array_equal(
+        catalog.scatter(catalog.movie_ids, scores[0, :1].repeat(4)), [1] * 4
+    )
+
+
+def test_projection_is_the_inverse_of_scatter(catalog):
+    movie_ids = np.array([8, 99, 3])
+    vector = np.array([0.5, 0, 2, 0], dtype=np.float32)
+
+    moved = vector @ catalog.projection(movie_ids)
+    np.testing.assert_array_equal(moved, [2, 0, 0.5])
+    np.testing.assert_array_equal(catalog.scatter(movie_ids, moved), vector)
+
+
+def test_genre_mask_and_with_genres(catalog):
+    comedy = catalog.genre_mask(["Comedy"])
+
+    np.testing.assert_array_equal(catalog.with_genres(comedy), [0, 1, 1, 0])
+    np.testing.assert_array_equal(
+        catalog.with_genres(catalog.genre_mask(["Action", "Comedy"])), [0, 1, 0, 0]
+    )
+    # no genre selected matches every movie
+    assert catalog.with_genres(catalog.genre_mask([])).all()
+    assert catalog.genres_of(2) == ["Comedy", "Drama"]
+
+
+def test_tags_keep_their_order(catalog):
+    assert catalog.tags_of(1) == ["funny", "dark"]
+    assert catalog.tags_of(0) == []
+
+
+def test_from_arrays_round_trip(catalog):
+    loaded = MovieCatalog.from_arrays(catalog.arrays())
+
+    assert loaded.matches(catalog.movie_ids)
+    assert loaded.titles == catalog.titles
+    # missing imdb ids come back as empty strings
+    assert loaded.imdb_ids == ["tt1", "", "tt3", "tt4"]
+    assert loaded.genres == GENRES and loaded.tags == catalog.tags
+    np.testing.assert_array_equal(loaded.genre_masks, catalog.genre_masks)
+    np.testing.assert_array_equal(loaded.positions([13, 3]), [3, 0])
+
+    for position in range(len(catalog)):
+        assert loaded.genres_of(position) == catalog.genres_of(position)
+        assert loaded.tags_of(position) == catalog.tags_of(position)